@@ -4,6 +4,9 @@ from pyrogram import idle
 from Backend import __version__, db
 from Backend.logger import LOGGER
 from Backend.fastapi import server
+from Backend.helper.chunk_cache import chunk_cache
+from Backend.helper.custom_dl import keep_media_sessions_alive
+from Backend.helper.drain import drainer
 from Backend.helper.pyro import restart_notification
 from Backend.pyrofork import StreamBot
 from Backend.pyrofork.clients import initialize_clients
@@ -13,6 +16,7 @@ loop = get_event_loop()
 async def start_services():
     try:
         LOGGER.info(f"Initializing Project-Stream v-{__version__}")
+        loop.create_task(chunk_cache.load())
         await asleep(1.2)
         
         await db.connect()
@@ -25,6 +29,7 @@ async def start_services():
         await asleep(1.2)
         LOGGER.info("Initializing Multi Clients...")
         await initialize_clients()
+        loop.create_task(keep_media_sessions_alive())
 
         await asleep(2)
         LOGGER.info('Initializing Project-S Web Server...')
@@ -39,6 +44,7 @@ async def start_services():
 async def stop_services():
     try:
         LOGGER.info("Stopping services...")
+        await drainer.drain()
         await StreamBot.stop()
         await db.disconnect()
         LOGGER.info("Services stopped successfully.")
@@ -0,0 +1,171 @@
+import asyncio
+import math
+import weakref
+from collections import defaultdict
+from time import monotonic
+from typing import Dict, Hashable, Optional
+from fastapi import HTTPException
+from Backend.logger import LOGGER
+from Backend.config import Telegram
+
+
+class Ticket:
+    """
+    One admitted stream. Releasing is idempotent so the streaming wrapper
+    and the garbage-collection backstop can both do it.
+    """
+
+    def __init__(self, control: "AdmissionControl", ip: str, file_key: Hashable):
+        self.control = control
+        self.ip = ip
+        self.file_key = file_key
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.control.release(self)
+
+
+class AdmissionControl:
+    """
+    Concurrency limits per client IP, per file and in total for /dl.
+    Requests over a limit wait up to `wait` seconds for a slot, then get
+    429 (per-IP limit) or 503 (file or server at capacity) with Retry-After.
+    """
+
+    def __init__(self, per_ip: int, per_file: int, total: int, wait: float):
+        self.per_ip = per_ip
+        self.per_file = per_file
+        self.total = total
+        self.wait = wait
+        self.ips: Dict[str, int] = defaultdict(int)
+        self.files: Dict[Hashable, int] = defaultdict(int)
+        self.active = 0
+        self.rejected = 0
+        self.draining = False
+        self._changed: Optional[asyncio.Event] = None
+
+    def _blocked_by(self, ip: str, file_key: Hashable) -> Optional[int]:
+        if self.per_ip > 0 and self.ips.get(ip, 0) >= self.per_ip:
+            return 429
+        if self.per_file > 0 and self.files.get(file_key, 0) >= self.per_file:
+            return 503
+        if self.total > 0 and self.active >= self.total:
+            return 503
+        return None
+
+    async def _wait_changed(self, timeout: float) -> None:
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def admit(self, ip: str, file_key: Hashable) -> Ticket:
+        if self.draining:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="Server restarting", headers={"Retry-After": "10"})
+        deadline = monotonic() + self.wait
+        while (status := self._blocked_by(ip, file_key)) is not None:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                self.rejected += 1
+                LOGGER.info(f"Rejected stream of {file_key} for {ip} with {status}")
+                raise HTTPException(
+                    status_code=status,
+                    detail="Too many concurrent streams" if status == 429 else "Server busy",
+                    headers={"Retry-After": str(max(1, math.ceil(self.wait)))},
+                )
+            await self._wait_changed(remaining)
+
+        self.ips[ip] += 1
+        self.files[file_key] += 1
+        self.active += 1
+        return Ticket(self, ip, file_key)
+
+    def release(self, ticket: Ticket) -> None:
+        self.active -= 1
+        for counts, key in ((self.ips, ticket.ip), (self.files, ticket.file_key)):
+            counts[key] -= 1
+            if counts[key] <= 0:
+                del counts[key]
+        if self._changed is not None:
+            # Wake every waiter to re-check its limits, then arm a fresh event.
+            self._changed.set()
+            self._changed = None
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """
+        wait up to timeout for every admitted stream to finish
+        """
+        deadline = monotonic() + timeout
+        while self.active and (remaining := deadline - monotonic()) > 0:
+            await self._wait_changed(remaining)
+        return not self.active
+
+    async def track(self, ticket: Ticket, body):
+        """
+        yield from body and give the slot back when the stream ends
+        """
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            ticket.release()
+
+    def guard(self, ticket: Ticket, body):
+        tracked = self.track(ticket, body)
+        # A body the server never starts iterating still frees its slot.
+        weakref.finalize(tracked, ticket.release)
+        return tracked
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self.active,
+            "clients": len(self.ips),
+            "files": len(self.files),
+            "rejected": self.rejected,
+        }
+
+
+class TokenBucket:
+    """
+    Bandwidth budget of one bot. Callers take tokens before each upstream
+    request and sleep off any debt, so requests are served in arrival order
+    at `rate` bytes per second on average.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    async def consume(self, size: int) -> None:
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= size
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class BandwidthShaper:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.buckets: Dict[int, TokenBucket] = {}
+
+    async def throttle(self, index: int, size: int) -> None:
+        if self.rate <= 0:
+            return
+        if index not in self.buckets:
+            self.buckets[index] = TokenBucket(self.rate, self.rate)
+        await self.buckets[index].consume(size)
+
+
+admission = AdmissionControl(
+    Telegram.MAX_STREAMS_PER_IP, Telegram.MAX_STREAMS_PER_FILE, Telegram.MAX_STREAMS, Telegram.ADMISSION_WAIT
+)
+shaper = BandwidthShaper(Telegram.BOT_BANDWIDTH_MBPS * 1024 * 1024 / 8)
@@ -0,0 +1,93 @@
+"""
+Compare peak memory of the streaming read-ahead path with copying slices
+and no buffer cap (the old behaviour) against memoryview slices under the
+process-wide ByteBudget.
+
+    python -m Backend.benchmarks.bench_buffers --streams 300 --budget-mb 512
+
+Each mode runs in its own subprocess so ru_maxrss is not shared between them.
+"""
+import argparse
+import asyncio
+import resource
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+
+import Backend.helper.custom_dl as custom_dl
+from Backend.helper.buffers import ByteBudget
+from Backend.helper.custom_dl import ByteStreamer
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def copy_cut(chunk: bytes, current_part: int, part_count: int, first_part_cut: int, last_part_cut: int) -> bytes:
+    if part_count == 1:
+        return chunk[first_part_cut:last_part_cut]
+    elif current_part == 1:
+        return chunk[first_part_cut:]
+    elif current_part == part_count:
+        return chunk[:last_part_cut]
+    return chunk
+
+
+async def run_stream(args, cut) -> int:
+    async def fetch(part_offset: int, limit: int, _: int) -> bytes:
+        await asyncio.sleep(args.latency)
+        return b"\x01" * limit
+
+    # Start mid-part and stop mid-part so both ends get trimmed.
+    first_part_cut, last_part_cut = CHUNK_SIZE // 3, CHUNK_SIZE // 2
+    sent = 0
+    current_part = 1
+    parts = [(part * CHUNK_SIZE, CHUNK_SIZE) for part in range(args.parts)]
+    async for chunk in ByteStreamer.read_ahead(fetch, parts, args.window):
+        piece = cut(chunk, current_part, args.parts, first_part_cut, last_part_cut)
+        # Simulate a client socket draining the piece.
+        await asyncio.sleep(args.send_delay)
+        sent += len(piece)
+        current_part += 1
+    return sent
+
+
+async def run_mode(args) -> None:
+    bounded = args.mode == "bounded"
+    custom_dl.buffer_budget = ByteBudget(args.budget_mb * CHUNK_SIZE if bounded else 0)
+    cut = ByteStreamer.cut_part if bounded else copy_cut
+
+    tracemalloc.start()
+    start = perf_counter()
+    sent = sum(await asyncio.gather(*(run_stream(args, cut) for _ in range(args.streams))))
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{args.mode:>8}: {args.streams} streams, {sent / CHUNK_SIZE:.0f} MB in {elapsed:.2f}s, "
+        f"peak traced {peak / CHUNK_SIZE:.0f} MB, "
+        f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB, "
+        f"peak budget {custom_dl.buffer_budget.peak / CHUNK_SIZE:.0f} MB"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--streams", type=int, default=300)
+    parser.add_argument("--parts", type=int, default=8)
+    parser.add_argument("--window", type=int, default=4)
+    parser.add_argument("--budget-mb", type=int, default=512)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per simulated GetFile")
+    parser.add_argument("--send-delay", type=float, default=0.1, help="seconds to drain one part to the client")
+    parser.add_argument("--mode", choices=["copy", "bounded"])
+    args = parser.parse_args()
+
+    if args.mode:
+        asyncio.run(run_mode(args))
+        return
+    for mode in ("copy", "bounded"):
+        subprocess.run([sys.executable, "-m", __spec__.name, *sys.argv[1:], "--mode", mode], check=True)
+
+
+if __name__ == "__main__":
+    main()
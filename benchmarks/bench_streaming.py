@@ -0,0 +1,221 @@
+"""
+End-to-end /dl benchmark against a simulated Telegram DC, so streaming
+changes can be measured without live bots.
+
+    python -m Backend.benchmarks.bench_streaming --readers 50 --duration 20
+
+Every bot client gets a fake media session whose send() answers GetFile
+after a configurable latency, shares one bandwidth-limited pipe per client
+and raises FloodWait with a configurable probability. The real FastAPI app
+is served by uvicorn in this process and hit by concurrent httpx range
+readers. Reported: throughput, TTFB p50/p99, max RSS and event-loop lag.
+The readers share the event loop with the server, so loop lag is an upper
+bound on what the server alone would see.
+
+Needs the same config.env as the app (the bot clients are never started).
+"""
+import argparse
+import asyncio
+import logging
+import random
+import resource
+import socket
+from time import perf_counter
+from typing import List
+
+import httpx
+import uvicorn
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId, FileType
+
+import Backend.helper.custom_dl as custom_dl
+from Backend.logger import LOGGER
+from Backend.helper.admission import admission
+from Backend.helper.encrypt import encode_string
+from Backend.pyrofork import multi_clients, work_loads
+
+CHUNK_SIZE = 1024 * 1024
+BLOCK = bytes(range(256)) * (CHUNK_SIZE // 256)
+
+
+class SimulatedSession:
+    """
+    Stands in for pyrogram's media Session. Requests wait out the latency in
+    parallel, then queue for the client's pipe to transfer their bytes.
+    """
+
+    def __init__(self, latency: float, bandwidth: float, flood_rate: float, flood_seconds: int):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.free_at = 0.0
+        self.calls = 0
+        self.floods = 0
+
+    async def send(self, query, timeout: float = None):
+        if isinstance(query, raw.functions.Ping):
+            return raw.types.Pong(msg_id=0, ping_id=query.ping_id)
+        self.calls += 1
+        if random.random() < self.flood_rate:
+            self.floods += 1
+            raise FloodWait(value=self.flood_seconds)
+        now = perf_counter()
+        start = max(now + self.latency, self.free_at)
+        self.free_at = start + query.limit / self.bandwidth
+        await asyncio.sleep(self.free_at - now)
+        offset = query.offset % CHUNK_SIZE
+        return raw.types.upload.File(
+            type=raw.types.storage.FilePartial(), mtime=0, bytes=BLOCK[offset:offset + query.limit]
+        )
+
+    async def stop(self) -> None:
+        pass
+
+
+class SimulatedClient:
+    def __init__(self, dc_id: int, session: SimulatedSession):
+        self.media_sessions = {dc_id: session}
+
+
+def fake_file_id(args, message_id: int) -> FileId:
+    file_id = FileId(
+        file_type=FileType.DOCUMENT, dc_id=args.dc, media_id=message_id, access_hash=message_id,
+        file_reference=b"bench"
+    )
+    file_id.file_name = f"bench{message_id}.mkv"
+    file_id.file_size = args.file_mb * CHUNK_SIZE
+    file_id.mime_type = "video/x-matroska"
+    file_id.unique_id = f"{message_id:06d}bench"
+    file_id.duration = 0
+    return file_id
+
+
+def setup(args) -> List[SimulatedSession]:
+    sessions = []
+    multi_clients.clear()
+    work_loads.clear()
+    for index in range(args.clients):
+        session = SimulatedSession(args.latency, args.bandwidth_mb * CHUNK_SIZE, args.flood_rate, args.flood_seconds)
+        sessions.append(session)
+        multi_clients[index] = SimulatedClient(args.dc, session)
+        work_loads[index] = 0
+    custom_dl.streamers.clear()
+
+    async def get_file_ids(client, chat_id: int, message_id: int) -> FileId:
+        return fake_file_id(args, message_id)
+
+    custom_dl.get_file_ids = get_file_ids
+    # Every reader connects from 127.0.0.1.
+    admission.per_ip = 0
+    return sessions
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def measure_loop_lag(lags: List[float], interval: float = 0.01) -> None:
+    while True:
+        start = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - start - interval)
+
+
+async def reader(args, client: httpx.AsyncClient, urls: List[str], deadline: float, ttfbs: List[float], totals: dict) -> None:
+    file_size = args.file_mb * CHUNK_SIZE
+    length = min(args.range_mb * CHUNK_SIZE, file_size)
+    while perf_counter() < deadline:
+        start = random.randrange(0, file_size - length + 1)
+        headers = {"Range": f"bytes={start}-{start + length - 1}"}
+        sent = perf_counter()
+        first = True
+        try:
+            async with client.stream("GET", random.choice(urls), headers=headers) as response:
+                if response.status_code != 206:
+                    totals["errors"] += 1
+                    continue
+                async for chunk in response.aiter_raw():
+                    if first:
+                        ttfbs.append(perf_counter() - sent)
+                        first = False
+                    totals["bytes"] += len(chunk)
+            totals["requests"] += 1
+        except httpx.HTTPError:
+            totals["errors"] += 1
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run(args) -> None:
+    from Backend.fastapi.main import app
+
+    sessions = setup(args)
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    urls = []
+    for message_id in range(1, args.files + 1):
+        encoded = await encode_string({"chat_id": "100", "msg_id": message_id, "hash": f"{message_id:06d}"})
+        urls.append(f"http://127.0.0.1:{port}/dl/{encoded}/bench{message_id}.mkv")
+
+    lags, ttfbs = [], []
+    totals = {"requests": 0, "errors": 0, "bytes": 0}
+    lag_task = asyncio.create_task(measure_loop_lag(lags))
+    limits = httpx.Limits(max_connections=args.readers, max_keepalive_connections=args.readers)
+    start = perf_counter()
+    async with httpx.AsyncClient(timeout=args.duration + 60, limits=limits) as client:
+        await asyncio.gather(*(
+            reader(args, client, urls, start + args.duration, ttfbs, totals) for _ in range(args.readers)
+        ))
+    elapsed = perf_counter() - start
+    lag_task.cancel()
+    server.should_exit = True
+    await serving
+
+    print(
+        f"{args.readers} readers, {args.clients} clients, {elapsed:.1f}s: "
+        f"{totals['requests']} ranges, {totals['errors']} errors, "
+        f"{totals['bytes'] / CHUNK_SIZE / elapsed:.1f} MB/s\n"
+        f"TTFB p50 {percentile(ttfbs, 0.5) * 1000:.0f} ms, p99 {percentile(ttfbs, 0.99) * 1000:.0f} ms\n"
+        f"loop lag p50 {percentile(lags, 0.5) * 1000:.1f} ms, p99 {percentile(lags, 0.99) * 1000:.1f} ms, "
+        f"max {max(lags, default=0) * 1000:.1f} ms\n"
+        f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB, "
+        f"GetFile calls {sum(s.calls for s in sessions)}, FloodWaits {sum(s.floods for s in sessions)}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=50, help="concurrent range readers")
+    parser.add_argument("--duration", type=float, default=20, help="seconds to keep issuing requests")
+    parser.add_argument("--clients", type=int, default=2, help="simulated bot clients")
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--file-mb", type=int, default=256)
+    parser.add_argument("--range-mb", type=int, default=8, help="bytes requested per range")
+    parser.add_argument("--dc", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.15, help="seconds per simulated GetFile")
+    parser.add_argument("--bandwidth-mb", type=float, default=20, help="MB/s of each client's pipe")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of FloodWait per GetFile")
+    parser.add_argument("--flood-seconds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    LOGGER.setLevel(logging.WARNING)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import asyncio
+from collections import deque
+from typing import Dict
+from Backend.config import Telegram
+
+
+class ByteBudget:
+    """
+    Process-wide cap on bytes that streams have fetched but not yet handed
+    to the HTTP server. A request larger than the whole budget is still let
+    through when nothing else is buffered, so it can never starve.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._waiters = deque()
+
+    def try_acquire(self, size: int) -> bool:
+        if self.limit > 0 and self.used and self.used + size > self.limit:
+            return False
+        self.used += size
+        self.peak = max(self.peak, self.used)
+        return True
+
+    async def acquire(self, size: int) -> None:
+        while not self.try_acquire(size):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self, size: int) -> None:
+        if not size:
+            return
+        self.used = max(0, self.used - size)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "used_mb": round(self.used / (1024 * 1024), 2),
+            "peak_mb": round(self.peak / (1024 * 1024), 2),
+            "limit_mb": round(self.limit / (1024 * 1024), 2),
+            "waiting": len(self._waiters),
+        }
+
+
+buffer_budget = ByteBudget(Telegram.MAX_BUFFER_MB * 1024 * 1024)
@@ -0,0 +1,225 @@
+import asyncio
+import mmap
+from collections import OrderedDict
+from os import listdir, makedirs, path as ospath, remove, replace, rmdir
+from typing import Dict, List, Optional, Set, Tuple
+from Backend.logger import LOGGER
+from Backend.config import Telegram
+
+# Telegram serves files in 1 MB parts; cache entries are stored on that grid.
+CHUNK_SIZE = 1024 * 1024
+# Blocks whose smaller parts are held in memory until the block is complete.
+PENDING_BLOCKS = 16
+
+
+class ChunkCache:
+    """
+    Size-bounded on-disk store of 1 MB file parts keyed by (unique_id, offset).
+    Hits are served as memoryviews over memory-mapped files, and entries are
+    evicted least-recently (lru) or least-frequently (lfu) used.
+    """
+
+    def __init__(self, directory: str, max_size: int, policy: str = "lru"):
+        self.directory = directory
+        self.max_size = max_size
+        self.policy = policy.lower()
+        self.entries: "OrderedDict[Tuple[str, int], list]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._writing: Set[Tuple[str, int]] = set()
+        self._pending: "OrderedDict[Tuple[str, int], Dict[int, bytes]]" = OrderedDict()
+        self._tasks: Set[asyncio.Task] = set()
+        # keys by hit count, for lfu eviction without scanning every entry
+        self._counts: Dict[int, "OrderedDict[Tuple[str, int], None]"] = {}
+        self._loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def _path(self, unique_id: str, offset: int) -> str:
+        return ospath.join(self.directory, unique_id, str(offset))
+
+    async def load(self) -> None:
+        """
+        rebuild the index from chunks left on disk by a previous run; the
+        cache is bypassed until the scan, run in the executor, has finished
+        """
+        if not self.enabled or self._loaded:
+            return
+        try:
+            found = await asyncio.get_running_loop().run_in_executor(None, self._scan)
+        except OSError as e:
+            LOGGER.error(f"Failed to load chunk cache from {self.directory}: {e}")
+            return
+        for _, key, size in found:
+            self.entries[key] = [size, 0]
+            self._track(key, 0)
+            self.size += size
+        self._loaded = True
+        self._evict()
+        LOGGER.info(f"Chunk cache loaded {len(self.entries)} chunks ({self.size // CHUNK_SIZE} MB) from {self.directory}")
+
+    def _scan(self) -> List[Tuple[float, Tuple[str, int], int]]:
+        makedirs(self.directory, exist_ok=True)
+        found = []
+        for unique_id in listdir(self.directory):
+            folder = ospath.join(self.directory, unique_id)
+            if not ospath.isdir(folder):
+                continue
+            for name in listdir(folder):
+                if not name.isdigit():
+                    continue
+                file_path = ospath.join(folder, name)
+                found.append((ospath.getmtime(file_path), (unique_id, int(name)), ospath.getsize(file_path)))
+        return sorted(found)
+
+    def _track(self, key: Tuple[str, int], count: int) -> None:
+        self._counts.setdefault(count, OrderedDict())[key] = None
+
+    def _untrack(self, key: Tuple[str, int], count: int) -> None:
+        keys = self._counts.get(count)
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self._counts[count]
+
+    def get(self, unique_id: str, offset: int, limit: int = CHUNK_SIZE) -> Optional[memoryview]:
+        """
+        return `limit` bytes at `offset` if the 1 MB part containing it is cached
+        """
+        if not self.enabled or not self._loaded:
+            return None
+        block = offset - (offset % CHUNK_SIZE)
+        key = (unique_id, block)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        try:
+            with open(self._path(unique_id, block), "rb") as f:
+                view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError):
+            self._drop(key)
+            self.misses += 1
+            return None
+        self._untrack(key, entry[1])
+        entry[1] += 1
+        self._track(key, entry[1])
+        self.entries.move_to_end(key)
+        self.hits += 1
+        start = offset - block
+        return view[start:start + limit]
+
+    def store(self, unique_id: str, offset: int, limit: int, data: bytes) -> None:
+        """
+        schedule a background write of a full, aligned part; smaller aligned
+        parts are collected until they make up their whole 1 MB block
+        """
+        if not self.enabled or not self._loaded or not data or offset % limit:
+            return
+        block = offset - (offset % CHUNK_SIZE)
+        key = (unique_id, block)
+        if key in self.entries or key in self._writing:
+            return
+        if limit != CHUNK_SIZE:
+            data = self._assemble(key, offset - block, limit, data)
+            if data is None:
+                return
+        else:
+            self._pending.pop(key, None)
+        self._writing.add(key)
+        task = asyncio.create_task(self._write(key, bytes(data)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _assemble(self, key: Tuple[str, int], start: int, limit: int, data: bytes) -> Optional[bytes]:
+        """
+        add one part to its pending block and return the whole block once
+        its parts run contiguously to 1 MB, or to the end of the file
+        """
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = [{}, CHUNK_SIZE]
+            while len(self._pending) > PENDING_BLOCKS:
+                self._pending.popitem(last=False)
+        parts = pending[0]
+        parts[start] = bytes(data)
+        if len(data) < limit:
+            # A short part ends the file, and with it this block.
+            pending[1] = start + len(data)
+        pieces, position = [], 0
+        while position < pending[1] and position in parts:
+            pieces.append(parts[position])
+            position += len(parts[position])
+        if position != pending[1]:
+            return None
+        del self._pending[key]
+        return b"".join(pieces)
+
+    async def flush(self) -> None:
+        """
+        wait for background writes still in progress
+        """
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _write(self, key: Tuple[str, int], data: bytes) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_file, self._path(*key), data)
+            self.entries[key] = [len(data), 1]
+            self._track(key, 1)
+            self.size += len(data)
+            self._evict()
+        except OSError as e:
+            LOGGER.error(f"Failed to cache chunk {key}: {e}")
+        finally:
+            self._writing.discard(key)
+
+    @staticmethod
+    def _write_file(file_path: str, data: bytes) -> None:
+        makedirs(ospath.dirname(file_path), exist_ok=True)
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        replace(tmp_path, file_path)
+
+    def _evict(self) -> None:
+        while self.size > self.max_size and self.entries:
+            if self.policy == "lfu":
+                # Oldest entry among those with the lowest hit count.
+                key = next(iter(self._counts[min(self._counts)]))
+            else:
+                key = next(iter(self.entries))
+            self._drop(key)
+
+    def _drop(self, key: Tuple[str, int]) -> None:
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry[0]
+            self._untrack(key, entry[1])
+        file_path = self._path(*key)
+        try:
+            remove(file_path)
+            folder = ospath.dirname(file_path)
+            if not listdir(folder):
+                rmdir(folder)
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "policy": self.policy,
+            "chunks": len(self.entries),
+            "size_mb": round(self.size / CHUNK_SIZE, 2),
+            "max_size_mb": round(self.max_size / CHUNK_SIZE, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+chunk_cache = ChunkCache(Telegram.CACHE_DIR, Telegram.CACHE_SIZE * CHUNK_SIZE, Telegram.CACHE_POLICY)
@@ -22,3 +22,39 @@ class Telegram:
     USE_TMDB = getenv("USE_TMDB", "False").lower() == "true"
     OWNER_ID = int(getenv("OWNER_ID", "6987799874"))
     USE_DEFAULT_ID = getenv("USE_DEFAULT_ID", None)
+
+    # Streaming
+    READ_AHEAD = int(getenv("READ_AHEAD", "4"))
+    FIRST_CHUNK_KB = int(getenv("FIRST_CHUNK_KB", "64"))
+    MAX_BUFFER_MB = int(getenv("MAX_BUFFER_MB", "512"))
+    DISCONNECT_POLL = float(getenv("DISCONNECT_POLL", "0.5"))
+    STRIPE_CLIENTS = int(getenv("STRIPE_CLIENTS", "1"))
+    CACHE_DIR = getenv("CACHE_DIR", "cache")
+    CACHE_SIZE = int(getenv("CACHE_SIZE", "0"))
+    CACHE_POLICY = getenv("CACHE_POLICY", "lru")
+    SCHEDULER = getenv("SCHEDULER", "ewma")
+    SCHEDULER_ALPHA = float(getenv("SCHEDULER_ALPHA", "0.2"))
+    MAX_FAILOVERS = int(getenv("MAX_FAILOVERS", "3"))
+    BREAKER_THRESHOLD = int(getenv("BREAKER_THRESHOLD", "3"))
+    BREAKER_COOLDOWN = float(getenv("BREAKER_COOLDOWN", "30"))
+    WARM_DCS = [int(dc) for dc in getenv("WARM_DCS", "1,2,3,4,5").split(",") if dc.strip()]
+    SESSION_CHECK_INTERVAL = int(getenv("SESSION_CHECK_INTERVAL", "120"))
+    FILE_CACHE_SIZE = int(getenv("FILE_CACHE_SIZE", "10000"))
+    FILE_CACHE_TTL = int(getenv("FILE_CACHE_TTL", "3600"))
+    SHARE_FILE_IDS = getenv("SHARE_FILE_IDS", "True").lower() == "true"
+    MAX_STREAMS = int(getenv("MAX_STREAMS", "0"))
+    MAX_STREAMS_PER_IP = int(getenv("MAX_STREAMS_PER_IP", "8"))
+    MAX_STREAMS_PER_FILE = int(getenv("MAX_STREAMS_PER_FILE", "0"))
+    ADMISSION_WAIT = float(getenv("ADMISSION_WAIT", "5"))
+    TRUSTED_PROXIES = int(getenv("TRUSTED_PROXIES", "1"))
+    BOT_BANDWIDTH_MBPS = float(getenv("BOT_BANDWIDTH_MBPS", "0"))
+    HLS_SEGMENT_MB = int(getenv("HLS_SEGMENT_MB", "4"))
+    HLS_SEGMENT_SECONDS = float(getenv("HLS_SEGMENT_SECONDS", "10"))
+    PREFETCH = getenv("PREFETCH", "False").lower() == "true"
+    PREFETCH_MB = int(getenv("PREFETCH_MB", "4"))
+    USE_CDN = getenv("USE_CDN", "False").lower() == "true"
+    DRAIN_TIMEOUT = float(getenv("DRAIN_TIMEOUT", "30"))
+
+    # Ingest
+    INGEST_BATCH_SIZE = int(getenv("INGEST_BATCH_SIZE", "200"))
+    INGEST_BATCH_WINDOW = float(getenv("INGEST_BATCH_WINDOW", "2"))
@@ -1,114 +1,421 @@
 import asyncio
+import base64
+from time import monotonic, time
+from collections import OrderedDict, deque
+from hashlib import sha1, sha256
+from contextlib import aclosing
 from pyrogram import utils, raw
-from pyrogram.errors import AuthBytesInvalid
+from pyrogram.crypto import aes, rsa
+from pyrogram.errors import AuthBytesInvalid, CDNFileHashMismatch, FileReferenceExpired, FileReferenceInvalid, FloodWait
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
+from pyrogram.raw.core.primitives import Bytes
 from pyrogram.session import Session, Auth
-from typing import Dict, Union
+from pyrogram.session.internals import DataCenter
+from typing import Dict, List, Optional, Set, Tuple, Union
+from Backend import db
 from Backend.logger import LOGGER
-from Backend.helper.exceptions import FIleNotFound
-from Backend.helper.pyro import get_file_ids
-from Backend.pyrofork import work_loads
+from Backend.config import Telegram
+from Backend.helper.admission import shaper
+from Backend.helper.buffers import buffer_budget
+from Backend.helper.chunk_cache import chunk_cache
+from Backend.helper.exceptions import CdnUnavailable, FIleNotFound
+from Backend.helper.file_cache import file_cache
+from Backend.helper import metrics
+from Backend.helper.pyro import file_id_from_record, file_id_to_record, get_file_ids
+from Backend.helper.scheduler import scheduler
+from Backend.helper.singleflight import SingleFlight
+from Backend.pyrofork import work_loads, multi_clients
 from pyrogram import Client, utils, raw
 
 
 class ByteStreamer:
-    def __init__(self, client: Client):
-        self.clean_timer = 30 * 60
+    def __init__(self, client: Client, index: int = 0):
         self.client: Client = client
-        self.__cached_file_ids: Dict[int, FileId] = {}
-        asyncio.create_task(self.clean_cache())
+        self.index = index
+        self.session_locks: Dict[int, asyncio.Lock] = {}
+        self.cdn_sessions: Dict[int, Session] = {}
+        self.cdn_locks: Dict[int, asyncio.Lock] = {}
+        # CDN redirects by unique_id (LRU), and when files whose CDN download
+        # failed on this client may try the CDN again; both capped at CDN_MEMORY
+        self.cdn_redirects: "OrderedDict[str, CdnRedirect]" = OrderedDict()
+        self.cdn_failed: "OrderedDict[str, float]" = OrderedDict()
+
+    @property
+    def uses_stored_file_ids(self) -> bool:
+        """
+        whether this client reads and writes the FileIds stored in the
+        database, which are StreamBot's (client 0) unless FileIds are shared
+        """
+        return Telegram.SHARE_FILE_IDS or self.index == 0
 
     async def get_file_properties(self, chat_id: int, message_id: int) -> FileId:
-        if message_id not in self.__cached_file_ids:
-            file_id = await get_file_ids(self.client, int(chat_id), int(message_id))
-            if not file_id:
-                LOGGER.info('Message with ID %s not found!', message_id)
-                raise FIleNotFound
-            self.__cached_file_ids[message_id] = file_id
-        return self.__cached_file_ids[message_id]
-
-    async def yield_file(self, file_id: FileId, index: int, offset: int, first_part_cut: int, last_part_cut: int, part_count: int, chunk_size: int) -> Union[str, None]: # type: ignore
-        client = self.client
-        work_loads[index] += 1
-        LOGGER.debug(f"Starting to yielding file with client {index}.")
-        media_session = await self.generate_media_session(client, file_id)
-        current_part = 1
-        location = await self.get_location(file_id)
+        async def load() -> FileId:
+            if self.uses_stored_file_ids:
+                try:
+                    record = await db.get_file_record(int(chat_id), int(message_id))
+                    if record:
+                        return file_id_from_record(record)
+                except Exception as e:
+                    LOGGER.error(f"Failed to read stored FileId of message {message_id}: {e}")
+            return await self.fetch_file_properties(chat_id, message_id)
+
+        return await file_cache.get(self.index, chat_id, message_id, load)
+
+    async def fetch_file_properties(self, chat_id: int, message_id: int) -> FileId:
+        """
+        resolve the FileId from Telegram and store it for later restarts
+        """
+        file_id = await get_file_ids(self.client, int(chat_id), int(message_id))
+        if not file_id:
+            LOGGER.info('Message with ID %s not found!', message_id)
+            raise FIleNotFound
+        if self.uses_stored_file_ids:
+            try:
+                await db.save_file_ids(int(chat_id), int(message_id), file_id_to_record(file_id))
+            except Exception as e:
+                LOGGER.error(f"Failed to store FileId of message {message_id}: {e}")
+        return file_id
+
+    async def refresh_file_properties(self, chat_id: int, message_id: int) -> FileId:
+        """
+        replace a FileId whose file_reference Telegram no longer accepts
+        """
+        file_cache.invalidate(chat_id, message_id)
+        return await file_cache.get(self.index, chat_id, message_id, lambda: self.fetch_file_properties(chat_id, message_id))
+
+    async def yield_file(self, file_id: FileId, from_bytes: int, until_bytes: int, chat_id: int = None, message_id: int = None) -> Union[str, None]: # type: ignore
+        """
+        Stream bytes from_bytes..until_bytes (inclusive) with this client.
+        When chat_id and message_id are given, the stream fails over to
+        another client mid-way if this one hits FloodWait, times out or
+        loses its media session.
+        """
+        LOGGER.debug(f"Starting to yielding file with client {self.index}.")
+        route = StreamRoute(self, file_id, chat_id, message_id)
+        await route.open()
+        async with aclosing(stream_routes([route], from_bytes, until_bytes)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    async def get_chunk(self, media_session: Session, location, file_id: FileId, offset: int, chunk_size: int) -> bytes:
+        """
+        fetch one part, serving it from the disk chunk cache or an identical
+        in-flight request when possible
+        """
+        cached = chunk_cache.get(file_id.unique_id, offset, chunk_size)
+        if cached is not None:
+            return cached
+
+        client, dc = str(self.index), str(file_id.dc_id)
+        started = False
+
+        async def download() -> bytes:
+            nonlocal started
+            started = True
+            await shaper.throttle(self.index, chunk_size)
+            start = time()
+            try:
+                data = await self.download_part(media_session, location, file_id, offset, chunk_size)
+            except FAILOVER_ERRORS as e:
+                if isinstance(e, FloodWait):
+                    scheduler.penalize(self.index, e.value)
+                    metrics.floodwaits.inc(client)
+                    metrics.floodwait_seconds.inc(client, amount=e.value)
+                    scheduler.record_failure(self.index)
+                elif self.client.media_sessions.get(file_id.dc_id) is media_session:
+                    # Parts still in flight on a dropped session fail along
+                    # with it; only the failure that dropped it counts.
+                    if not isinstance(e, TimeoutError):
+                        # The connection is gone. A single timeout is not
+                        # session loss; check_media_sessions pings for that.
+                        self.drop_media_session(file_id.dc_id, media_session)
+                    scheduler.record_failure(self.index)
+                metrics.getfile_errors.inc(client, type(e).__name__)
+                raise
+            if data is None:
+                return b""
+            elapsed = time() - start
+            scheduler.record(self.index, elapsed, len(data))
+            metrics.getfile_latency.observe(elapsed, client, dc)
+            metrics.getfile_bytes.inc(client, dc, amount=len(data))
+            chunk_cache.store(file_id.unique_id, offset, chunk_size, data)
+            return data
+
+        # Concurrent readers of the same part share a single upstream GetFile.
         try:
-            r = await media_session.send(raw.functions.upload.GetFile(location=location, offset=offset, limit=chunk_size))
+            return await chunk_flights.do((file_id.unique_id, offset, chunk_size), download)
+        except FAILOVER_ERRORS:
+            if started:
+                raise
+            # The request another client made failed; that says nothing
+            # about this client, so it tries the part itself first.
+            return await download()
+
+    async def download_part(self, media_session: Session, location, file_id: FileId, offset: int, chunk_size: int) -> Optional[bytes]:
+        """
+        GetFile one part from the file's DC, or from a CDN DC once Telegram
+        has redirected this file there. A CDN failure other than FloodWait
+        sends the file back to its own DC for the rest of this process.
+        """
+        unique_id = file_id.unique_id
+        redirect = self.cdn_redirects.get(unique_id)
+        if redirect is not None:
+            self.cdn_redirects.move_to_end(unique_id)
+        else:
+            cdn_supported = Telegram.USE_CDN and not self.cdn_recently_failed(unique_id)
+            r = await media_session.send(
+                raw.functions.upload.GetFile(
+                    location=location, offset=offset, limit=chunk_size, cdn_supported=cdn_supported or None
+                )
+            )
             if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
-                    
-                    r = await media_session.send(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
-        except (TimeoutError, AttributeError):
-            pass
-        finally:
-            LOGGER.debug("Finished yielding file with {current_part} parts.")
-            work_loads[index] -= 1
+                return r.bytes
+            if not isinstance(r, raw.types.upload.FileCdnRedirect):
+                return None
+            redirect = self.cdn_redirects[unique_id] = CdnRedirect(r)
+            while len(self.cdn_redirects) > CDN_MEMORY:
+                self.cdn_redirects.popitem(last=False)
+            LOGGER.debug(f"File {unique_id} redirected to CDN DC {r.dc_id}")
 
-    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(
+        try:
+            data = await self.get_cdn_part(media_session, redirect, offset, chunk_size)
+            metrics.cdn_parts.inc(str(self.index))
+            return data
+        except FloodWait:
+            raise
+        except Exception as e:
+            LOGGER.warning(f"CDN download of {unique_id} failed on client {self.index}, using DC {file_id.dc_id}: {e!r}")
+            metrics.cdn_fallbacks.inc(str(self.index))
+            self.cdn_redirects.pop(unique_id, None)
+            self.cdn_failed[unique_id] = monotonic() + CDN_RETRY_AFTER
+            self.cdn_failed.move_to_end(unique_id)
+            while len(self.cdn_failed) > CDN_MEMORY:
+                self.cdn_failed.popitem(last=False)
+            return await self.download_part(media_session, location, file_id, offset, chunk_size)
+
+    def cdn_recently_failed(self, unique_id: str) -> bool:
+        retry_at = self.cdn_failed.get(unique_id)
+        if retry_at is None:
+            return False
+        if retry_at <= monotonic():
+            del self.cdn_failed[unique_id]
+            return False
+        return True
+
+    async def get_cdn_part(self, media_session: Session, redirect: "CdnRedirect", offset: int, limit: int) -> bytes:
+        """
+        GetCdnFile, decrypt and verify one part, asking the file's DC to
+        reupload it to the CDN when the CDN does not have it yet
+        """
+        # Hashes cover whole 128 KB regions, so a smaller part is fetched as
+        # its enclosing region and cut out after verification.
+        region_offset = offset - offset % CDN_HASH_SIZE
+        region_limit = max(limit, CDN_HASH_SIZE)
+        cdn_session = await self.get_cdn_session(redirect.dc_id)
+        for _ in range(2):
+            try:
+                r = await cdn_session.send(
+                    raw.functions.upload.GetCdnFile(file_token=redirect.file_token, offset=region_offset, limit=region_limit)
+                )
+            except (TimeoutError, OSError):
+                self.drop_cdn_session(redirect.dc_id, cdn_session)
+                raise
+            if not isinstance(r, raw.types.upload.CdnFileReuploadNeeded):
+                break
+            redirect.add_hashes(await media_session.send(
+                raw.functions.upload.ReuploadCdnFile(file_token=redirect.file_token, request_token=r.request_token)
+            ))
+        else:
+            raise CdnUnavailable
+
+        # https://core.telegram.org/cdn#decrypting-files
+        data = aes.ctr256_decrypt(
+            r.bytes,
+            redirect.encryption_key,
+            bytearray(redirect.encryption_iv[:-4] + (region_offset // 16).to_bytes(4, "big")),
+        )
+        await self.verify_cdn_part(media_session, redirect, region_offset, data)
+        start = offset - region_offset
+        return data[start:start + limit]
+
+    @staticmethod
+    async def verify_cdn_part(media_session: Session, redirect: "CdnRedirect", offset: int, data: bytes) -> None:
+        """
+        check every hash region of data, fetching hashes the redirect did not carry
+        """
+        # https://core.telegram.org/cdn#verifying-files
+        position = offset
+        while position < offset + len(data):
+            file_hash = redirect.hashes.get(position)
+            if file_hash is None:
+                redirect.add_hashes(await media_session.send(
+                    raw.functions.upload.GetCdnFileHashes(file_token=redirect.file_token, offset=position)
+                ))
+                file_hash = redirect.hashes.get(position)
+                CDNFileHashMismatch.check(file_hash is not None, f"hash for offset {position} is known")
+            piece = data[position - offset:position - offset + file_hash.limit]
+            CDNFileHashMismatch.check(sha256(piece).digest() == file_hash.hash, "file_hash.hash == sha256(piece).digest()")
+            position += file_hash.limit
+
+    async def get_cdn_session(self, dc_id: int) -> Session:
+        cdn_session = self.cdn_sessions.get(dc_id)
+        if cdn_session is not None:
+            return cdn_session
+        async with self.cdn_locks.setdefault(dc_id, asyncio.Lock()):
+            if dc_id not in self.cdn_sessions:
+                client = self.client
+                await cdn_directory.register(client, dc_id)
+                cdn_session = Session(
                     client,
-                    file_id.dc_id,
-                    await Auth(client, file_id.dc_id, await client.storage.test_mode()).create(),
+                    dc_id,
+                    await Auth(client, dc_id, await client.storage.test_mode()).create(),
                     await client.storage.test_mode(),
                     is_media=True,
+                    is_cdn=True,
                 )
-                await media_session.start()
+                await cdn_session.start()
+                LOGGER.debug(f"Created CDN session for DC {dc_id} on client {self.index}")
+                self.cdn_sessions[dc_id] = cdn_session
+        return self.cdn_sessions[dc_id]
+
+    def drop_cdn_session(self, dc_id: int, cdn_session: Session) -> None:
+        if self.cdn_sessions.get(dc_id) is cdn_session:
+            self.cdn_sessions.pop(dc_id, None)
+            asyncio.create_task(cdn_session.stop())
+            LOGGER.debug(f"Dropped CDN session for DC {dc_id} on client {self.index}")
+
+    @staticmethod
+    async def read_ahead(fetch, parts: List[Tuple[int, int]], window: int):
+        """
+        Keep up to `window` fetch(part_offset, limit, part_index) calls in
+        flight and yield their results in order. Every buffered part holds
+        its limit in bytes of the process-wide buffer budget until the
+        consumer takes it; a stream only waits for budget when it has
+        nothing in flight.
+        """
+        window = max(1, window)
+        pending = deque()
+        next_part = 0
+        held = 0
+        try:
+            for _ in range(len(parts)):
+                while len(pending) < window and next_part < len(parts):
+                    part_offset, limit = parts[next_part]
+                    if not pending:
+                        await buffer_budget.acquire(limit)
+                    elif not buffer_budget.try_acquire(limit):
+                        break
+                    pending.append((asyncio.create_task(fetch(part_offset, limit, next_part)), limit))
+                    next_part += 1
+                task, held = pending.popleft()
+                yield await task
+                buffer_budget.release(held)
+                held = 0
+        finally:
+            for task, _ in pending:
+                task.cancel()
+            # Release before awaiting: when the server cancels a response, this
+            # await can be cancelled again and nothing after it would run.
+            buffer_budget.release(held + sum(limit for _, limit in pending))
+            if pending:
+                await asyncio.gather(*(task for task, _ in pending), return_exceptions=True)
+
+    @staticmethod
+    def cut_part(chunk: bytes, current_part: int, part_count: int, first_part_cut: int, last_part_cut: int) -> memoryview:
+        """
+        trim the first and last parts without copying them
+        """
+        if part_count == 1:
+            return memoryview(chunk)[first_part_cut:last_part_cut]
+        elif current_part == 1:
+            return memoryview(chunk)[first_part_cut:]
+        elif current_part == part_count:
+            return memoryview(chunk)[:last_part_cut]
+        return chunk
+
+    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
+        return await self.get_media_session(file_id.dc_id)
+
+    async def get_media_session(self, dc_id: int) -> Session:
+        media_session = self.client.media_sessions.get(dc_id, None)
+        if media_session is not None:
+            LOGGER.debug(f"Using cached media session for DC {dc_id}")
+            return media_session
+        # One lock per (client, dc) so concurrent first requests share one session.
+        async with self.session_locks.setdefault(dc_id, asyncio.Lock()):
+            media_session = self.client.media_sessions.get(dc_id, None)
+            if media_session is None:
+                media_session = await self.create_media_session(dc_id)
+                if media_session is not None:
+                    LOGGER.debug(f"Created media session for DC {dc_id}")
+                    self.client.media_sessions[dc_id] = media_session
+        return media_session
+
+    async def create_media_session(self, dc_id: int) -> Session:
+        client = self.client
+        if dc_id != await client.storage.dc_id():
+            media_session = Session(
+                client,
+                dc_id,
+                await Auth(client, dc_id, await client.storage.test_mode()).create(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+            try:
                 for _ in range(6):
-                    exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id))
+                    exported_auth = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
                     try:
-                        
                         await media_session.send(raw.functions.auth.ImportAuthorization(id=exported_auth.id, bytes=exported_auth.bytes))
                         break
                     except AuthBytesInvalid:
-                        LOGGER.debug(f"Invalid authorization bytes for DC {file_id.dc_id}, retrying...")
+                        LOGGER.debug(f"Invalid authorization bytes for DC {dc_id}, retrying...")
                     except OSError:
                         LOGGER.debug(f"Connection error, retrying...")
                         await asyncio.sleep(2)
                 else:
                     await media_session.stop()
-                    LOGGER.debug(f"Failed to establish media session for DC {file_id.dc_id} after multiple retries")
-                    return None 
-            else:
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await client.storage.auth_key(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-            LOGGER.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
+                    LOGGER.debug(f"Failed to establish media session for DC {dc_id} after multiple retries")
+                    return None
+            except BaseException:
+                # A started session keeps its connection and ping task running.
+                await media_session.stop()
+                raise
         else:
-            LOGGER.debug(f"Using cached media session for DC {file_id.dc_id}")
+            media_session = Session(
+                client,
+                dc_id,
+                await client.storage.auth_key(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
         return media_session
 
+    async def check_media_sessions(self) -> None:
+        """
+        ping every open media session and rebuild the ones that stopped answering
+        """
+        for dc_id, media_session in list(self.client.media_sessions.items()):
+            try:
+                await media_session.send(raw.functions.Ping(ping_id=0), timeout=10)
+            except Exception as e:
+                LOGGER.warning(f"Media session for DC {dc_id} on client {self.index} is unhealthy: {e!r}")
+                self.drop_media_session(dc_id, media_session)
+                try:
+                    await self.get_media_session(dc_id)
+                except Exception as e:
+                    LOGGER.error(f"Failed to rebuild media session for DC {dc_id} on client {self.index}: {e}")
+
+    def drop_media_session(self, dc_id: int, media_session: Session) -> None:
+        """
+        forget a broken media session so the next request builds a new one
+        """
+        if media_session is not None and self.client.media_sessions.get(dc_id) is media_session:
+            self.client.media_sessions.pop(dc_id, None)
+            asyncio.create_task(media_session.stop())
+            LOGGER.debug(f"Dropped media session for DC {dc_id} on client {self.index}")
+
 
     @staticmethod
     async def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation, raw.types.InputDocumentFileLocation, raw.types.InputPeerPhotoFileLocation]:
@@ -139,11 +446,327 @@ class ByteStreamer:
                                                            thumb_size=file_id.thumbnail_size)
         return location
 
-    async def clean_cache(self) -> None:
-        """
-        function to clean the cache to reduce memory usage
-        """
+
+streamers: Dict[int, ByteStreamer] = {}
+chunk_flights = SingleFlight()
+
+class CdnRedirect:
+    """
+    upload.FileCdnRedirect of one file, with the part hashes known so far
+    """
+
+    def __init__(self, redirect: raw.types.upload.FileCdnRedirect):
+        self.dc_id = redirect.dc_id
+        self.file_token = redirect.file_token
+        self.encryption_key = redirect.encryption_key
+        self.encryption_iv = redirect.encryption_iv
+        self.hashes: Dict[int, raw.types.FileHash] = {}
+        self.add_hashes(redirect.file_hashes)
+
+    def add_hashes(self, hashes: List[raw.types.FileHash]) -> None:
+        for file_hash in hashes:
+            self.hashes[file_hash.offset] = file_hash
+
+
+def rsa_public_key(pem: str) -> rsa.PublicKey:
+    """
+    modulus and exponent of a PEM "RSA PUBLIC KEY" (PKCS#1 SEQUENCE of two INTEGERs)
+    """
+    der = base64.b64decode("".join(line for line in pem.splitlines() if line and not line.startswith("-----")))
+
+    def read(position: int) -> Tuple[int, int]:
+        # skip tag and length, return where the content starts and ends
+        length = der[position + 1]
+        position += 2
+        if length & 0x80:
+            size = length & 0x7f
+            length = int.from_bytes(der[position:position + size], "big")
+            position += size
+        return position, position + length
+
+    sequence, _ = read(0)
+    start, end = read(sequence)
+    modulus = int.from_bytes(der[start:end], "big")
+    start, end = read(end)
+    return rsa.PublicKey(modulus, int.from_bytes(der[start:end], "big"))
+
+
+def rsa_fingerprint(key: rsa.PublicKey) -> int:
+    """
+    lower 64 bits of SHA1 over the TL-serialized key, as res_pq lists them
+    """
+    serialized = b"".join(
+        Bytes(value.to_bytes((value.bit_length() + 7) // 8, "big")) for value in (key.m, key.e)
+    )
+    return int.from_bytes(sha1(serialized).digest()[-8:], "little", signed=True)
+
+
+class CdnDirectory:
+    """
+    Addresses and RSA keys of Telegram's CDN DCs. pyrogram connects to a DC
+    through its built-in DataCenter table and authorizes against its
+    built-in server keys, which only cover CDN DC 203; any other CDN DC is
+    looked up in help.GetConfig and help.GetCdnConfig on first use and
+    registered in both.
+    """
+
+    def __init__(self):
+        self.registered: Set[int] = set()
+        self.lock = asyncio.Lock()
+
+    async def register(self, client: Client, dc_id: int) -> None:
+        if dc_id in self.registered:
+            return
+        async with self.lock:
+            if dc_id in self.registered:
+                return
+            test_mode = await client.storage.test_mode()
+            config = await client.invoke(raw.functions.help.GetConfig())
+            options = [
+                option for option in config.dc_options
+                if option.id == dc_id and option.cdn and bool(option.ipv6) == bool(client.ipv6)
+            ]
+            # DataCenter always dials 443 (5222 with alt_port)
+            options.sort(key=lambda option: option.port != (5222 if client.alt_port else 443))
+            if not options:
+                raise CdnUnavailable(f"No address for CDN DC {dc_id}")
+            if test_mode:
+                table = DataCenter.TEST_IPV6 if client.ipv6 else DataCenter.TEST
+            else:
+                table = DataCenter.PROD_IPV6 if client.ipv6 else DataCenter.PROD
+            table[dc_id] = options[0].ip_address
+
+            cdn_config = await client.invoke(raw.functions.help.GetCdnConfig())
+            for public_key in cdn_config.public_keys:
+                key = rsa_public_key(public_key.public_key)
+                rsa.server_public_keys.setdefault(rsa_fingerprint(key), key)
+            self.registered.add(dc_id)
+            LOGGER.info(f"Registered CDN DC {dc_id} at {options[0].ip_address}")
+
+
+cdn_directory = CdnDirectory()
+
+# GetFile limits must be powers of two between 4 KB and 1 MB.
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+# CDN parts are hashed in regions of this size.
+CDN_HASH_SIZE = 128 * 1024
+# Redirects and CDN failures remembered per client, and seconds before a
+# file whose CDN download failed is offered to the CDN again.
+CDN_MEMORY = 4096
+CDN_RETRY_AFTER = 3600
+
+# Errors after which a stream is moved to another client.
+FAILOVER_ERRORS = (FloodWait, TimeoutError, OSError, AttributeError)
+
+
+def get_streamer(index: int) -> ByteStreamer:
+    """
+    return the ByteStreamer bound to multi_clients[index], creating it on first use
+    """
+    if index not in streamers:
+        LOGGER.debug(f"Creating new ByteStreamer object for client {index}")
+        streamers[index] = ByteStreamer(multi_clients[index], index)
+    return streamers[index]
+
+
+class StreamRoute:
+    """
+    The client currently serving a stream. When that client fails, the
+    route moves to the best remaining client and the failed part is
+    retried from the same offset.
+    """
+
+    def __init__(self, streamer: ByteStreamer, file_id: FileId, chat_id: int = None, message_id: int = None):
+        self.streamer = streamer
+        self.file_id = file_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.media_session = None
+        self.location = None
+        self.tried = {streamer.index}
+        self.lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        self.media_session = await self.streamer.generate_media_session(self.streamer.client, self.file_id)
+        self.location = await self.streamer.get_location(self.file_id)
+        work_loads[self.streamer.index] += 1
+
+    def close(self) -> None:
+        work_loads[self.streamer.index] -= 1
+
+    async def fetch(self, offset: int, chunk_size: int) -> bytes:
+        refreshed = False
         while True:
-            await asyncio.sleep(self.clean_timer)
-            self.__cached_file_ids.clear()
-            LOGGER.debug("Cleaned the cache")
+            streamer, file_id = self.streamer, self.file_id
+            try:
+                return await streamer.get_chunk(self.media_session, self.location, file_id, offset, chunk_size)
+            except FAILOVER_ERRORS as e:
+                LOGGER.warning(f"Client {streamer.index} failed at offset {offset}: {e!r}")
+                if not await self.failover(streamer):
+                    raise
+            except (FileReferenceExpired, FileReferenceInvalid):
+                if refreshed or self.chat_id is None or self.message_id is None:
+                    raise
+                refreshed = True
+                await self.refresh(file_id)
+
+    async def refresh(self, stale: FileId) -> None:
+        async with self.lock:
+            if self.file_id is not stale:
+                return
+            LOGGER.info(f"Refreshing file reference of message {self.message_id}")
+            self.file_id = await self.streamer.refresh_file_properties(self.chat_id, self.message_id)
+            self.location = await self.streamer.get_location(self.file_id)
+
+    async def failover(self, failed: ByteStreamer) -> bool:
+        if self.chat_id is None or self.message_id is None:
+            return False
+        async with self.lock:
+            if self.streamer is not failed:
+                # Another in-flight part already moved the route.
+                return True
+            while len(self.tried) <= Telegram.MAX_FAILOVERS:
+                ranked = scheduler.rank(self.file_id.dc_id, exclude=self.tried)
+                if not ranked:
+                    break
+                index = ranked[0]
+                self.tried.add(index)
+                streamer = get_streamer(index)
+                try:
+                    file_id = await streamer.get_file_properties(chat_id=self.chat_id, message_id=self.message_id)
+                    media_session = await streamer.generate_media_session(streamer.client, file_id)
+                except Exception as e:
+                    LOGGER.debug(f"Client {index} cannot take over message {self.message_id}: {e}")
+                    scheduler.record_failure(index)
+                    continue
+                if media_session is None:
+                    continue
+                work_loads[failed.index] -= 1
+                work_loads[index] += 1
+                self.streamer, self.file_id, self.media_session = streamer, file_id, media_session
+                self.location = await streamer.get_location(file_id)
+                LOGGER.info(f"Stream of message {self.message_id} moved from client {failed.index} to {index}")
+                return True
+        return False
+
+
+def plan_parts(from_bytes: int, until_bytes: int, first_chunk: int = MAX_CHUNK_SIZE) -> List[Tuple[int, int]]:
+    """
+    Split from_bytes..until_bytes into (offset, limit) GetFile requests.
+    The first request is first_chunk bytes for a fast first byte, and each
+    following one doubles up to 1 MB. Every limit is a power of two and
+    every offset a multiple of its limit, which keeps requests within
+    Telegram's rules: 4 KB alignment, limit dividing 1 MB, and no request
+    crossing a 1 MB boundary.
+    """
+    size = min(max(first_chunk, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+    size = 1 << (size.bit_length() - 1)
+    offset = from_bytes - (from_bytes % size)
+    parts = []
+    while offset <= until_bytes:
+        limit = size
+        while offset % limit:
+            limit //= 2
+        parts.append((offset, limit))
+        offset += limit
+        size = min(size * 2, MAX_CHUNK_SIZE)
+    return parts
+
+
+async def stream_routes(routes: List[StreamRoute], from_bytes: int, until_bytes: int) -> Union[str, None]: # type: ignore
+    """
+    Yield bytes from_bytes..until_bytes in order, spreading the parts
+    round-robin over the already opened routes, and release the routes
+    when done.
+    """
+    parts = plan_parts(from_bytes, until_bytes, Telegram.FIRST_CHUNK_KB * 1024)
+    part_count = len(parts)
+    first_part_cut = from_bytes - parts[0][0]
+    last_part_cut = until_bytes - parts[-1][0] + 1
+    current_part = 1
+
+    async def fetch(part_offset: int, limit: int, part_index: int):
+        return await routes[part_index % len(routes)].fetch(part_offset, limit)
+
+    window = Telegram.READ_AHEAD * len(routes)
+    try:
+        async with aclosing(ByteStreamer.read_ahead(fetch, parts, window)) as chunks:
+            async for chunk in chunks:
+                if not chunk:
+                    break
+                yield ByteStreamer.cut_part(chunk, current_part, part_count, first_part_cut, last_part_cut)
+                current_part += 1
+    except FAILOVER_ERRORS as e:
+        LOGGER.error(f"Stream ended at part {current_part}/{part_count}: {e!r}")
+    finally:
+        LOGGER.debug(f"Finished yielding file with {current_part} parts.")
+        for route in routes:
+            route.close()
+
+
+async def yield_striped_file(chat_id: int, message_id: int, indexes: List[int], from_bytes: int, until_bytes: int, fallback: ByteStreamer, file_id: FileId) -> Union[str, None]: # type: ignore
+    """
+    Stream one range with its parts spread round-robin over several clients.
+    Every client resolves its own FileId and media session, and each stripe
+    fails over independently. When no client can open the file, the range
+    is streamed by `fallback` with its already resolved `file_id`.
+    """
+    async def open_route(index: int):
+        streamer = get_streamer(index)
+        try:
+            file_id = await streamer.get_file_properties(chat_id=chat_id, message_id=message_id)
+            route = StreamRoute(streamer, file_id, chat_id, message_id)
+            await route.open()
+        except Exception as e:
+            LOGGER.debug(f"Client {index} dropped from stripe: {e}")
+            return None
+        if route.media_session is None:
+            route.close()
+            return None
+        return route
+
+    routes = [route for route in await asyncio.gather(*(open_route(i) for i in indexes)) if route]
+    if not routes:
+        LOGGER.debug(f"No client could open message {message_id} for striping, using client {fallback.index}")
+        async with aclosing(fallback.yield_file(file_id, from_bytes, until_bytes, chat_id, message_id)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+        return
+
+    LOGGER.debug(f"Striping bytes {from_bytes}-{until_bytes} over clients {[route.streamer.index for route in routes]}")
+    async with aclosing(stream_routes(routes, from_bytes, until_bytes)) as chunks:
+        async for chunk in chunks:
+            yield chunk
+
+
+async def warm_media_sessions() -> None:
+    """
+    open a media session on every WARM_DCS data center for every client
+    """
+    async def warm(streamer: ByteStreamer) -> int:
+        # One DC after another per client: every session to a foreign DC
+        # costs an auth.ExportAuthorization, which Telegram flood-limits.
+        warmed = 0
+        for dc_id in Telegram.WARM_DCS:
+            try:
+                warmed += await streamer.get_media_session(dc_id) is not None
+            except Exception as e:
+                LOGGER.warning(f"Failed to warm media session for DC {dc_id} on client {streamer.index}: {e}")
+        return warmed
+
+    indexes = list(multi_clients)
+    if indexes and Telegram.WARM_DCS:
+        warmed = await asyncio.gather(*(warm(get_streamer(index)) for index in indexes))
+        LOGGER.info(f"Warmed {sum(warmed)}/{len(indexes) * len(Telegram.WARM_DCS)} media sessions")
+
+
+async def keep_media_sessions_alive() -> None:
+    """
+    warm the session pool at startup, then health-check it periodically
+    """
+    await warm_media_sessions()
+    while Telegram.SESSION_CHECK_INTERVAL > 0:
+        await asyncio.sleep(Telegram.SESSION_CHECK_INTERVAL)
+        for index in list(multi_clients):
+            await get_streamer(index).check_media_sessions()
@@ -1,10 +1,15 @@
+import asyncio
+import base64
+import re
 from datetime import datetime
+from time import monotonic
 from typing import Dict, List, Optional, Tuple, Union
-from bson import ObjectId
+from bson import ObjectId, json_util
 from fastapi import HTTPException
 import motor.motor_asyncio
 from pydantic import ValidationError
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 
 from Backend.logger import LOGGER
 from Backend.config import Telegram
@@ -12,15 +17,292 @@ from Backend.helper.encrypt import encode_string
 from Backend.helper.modal import Episode, MovieSchema, QualityDetail, Season, TVShowSchema
 
 
+# Key orders the listing endpoints sort by; each has an index ending in _id.
+LISTING_SORTS: List[List[Tuple[str, int]]] = [
+    [("rating", DESCENDING), ("release_year", DESCENDING)],
+    [("updated_on", DESCENDING)],
+]
+
+
+def _listing_sort(sort_params: List[Tuple[str, str]]) -> List[Tuple[str, int]]:
+    """
+    sort_params as pymongo sort keys, with a total order for keyset paging.
+    A sort that is a prefix of a LISTING_SORTS entry (or its reverse) is
+    completed with the rest of that entry's keys and _id, so it can walk the
+    entry's index (e.g. rating:desc becomes rating, release_year, _id);
+    any other sort just gets _id appended and is sorted in memory.
+    """
+    sort_criteria = [(field, ASCENDING if direction == "asc" else DESCENDING) 
+                     for field, direction in sort_params if field != "_id"]
+    for keys in LISTING_SORTS:
+        for flip in (1, -1):
+            walked = [(field, direction * flip) for field, direction in keys]
+            if sort_criteria and walked[:len(sort_criteria)] == sort_criteria:
+                return walked + [("_id", ASCENDING * flip)]
+    return sort_criteria + [("_id", ASCENDING)]
+
+
+# Words are indexed by each of their prefixes of SEARCH_MIN_LENGTH up to
+# SEARCH_PREFIX_LENGTH characters. Shorter typed words are ignored: a single
+# letter starts a word of most documents, so it would not narrow anything.
+SEARCH_MIN_LENGTH = 2
+SEARCH_PREFIX_LENGTH = 20
+
+
+def _search_words(text: str) -> List[str]:
+    """lowercased words of text, split on anything but letters and digits"""
+    return [word for word in re.split(r"[\W_]+", text.lower()) if word]
+
+
+def _prefixes(texts: List[Optional[str]]) -> List[str]:
+    return sorted({
+        word[:end]
+        for text in texts if text
+        for word in _search_words(text)
+        for end in range(SEARCH_MIN_LENGTH, min(len(word), SEARCH_PREFIX_LENGTH) + 1)
+    })
+
+
+def _search_fields(document: dict) -> Dict[str, List[str]]:
+    """
+    word prefixes of a catalog document: title_prefixes for its title, and
+    search_prefixes for its title and file names, which search_documents
+    matches typed words against through the search_prefixes index
+    """
+    names = [q["name"] for q in document.get("telegram") or []]
+    for season in document.get("seasons") or []:
+        for episode in season.get("episodes") or []:
+            names.extend(q["name"] for q in episode.get("telegram") or [])
+    title_prefixes = _prefixes([document.get("title")])
+    return {
+        "title_prefixes": title_prefixes,
+        "search_prefixes": sorted(set(title_prefixes).union(_prefixes(names))),
+    }
+
+
+# Search-only fields left out of documents returned by the API.
+SEARCH_FIELDS = {"title_prefixes": 0, "search_prefixes": 0}
+
+
+def _add_search_prefixes(document: dict) -> dict:
+    """update adding the word prefixes of document's title and files to a stored one"""
+    return {"$addToSet": {"search_prefixes": {"$each": _search_fields(document)["search_prefixes"]}}}
+
+
+def _catalog_indexes() -> List[IndexModel]:
+    return [
+        IndexModel([("tmdb_id", ASCENDING)], name="tmdb_id_unique", unique=True),
+        IndexModel([("title", ASCENDING), ("release_year", ASCENDING)], name="title_release_year"),
+        # Listing sorts end on _id so keyset pages never need an in-memory sort.
+        *[
+            IndexModel(keys + [("_id", ASCENDING)], name="_".join(field for field, _ in keys) + "_id")
+            for keys in LISTING_SORTS
+        ],
+        IndexModel([("genres", ASCENDING), ("rating", DESCENDING)], name="genres_rating"),
+        # Backs search_documents, including the partial last word of type-ahead.
+        IndexModel([("search_prefixes", ASCENDING)], name="search_prefixes"),
+    ]
+
+
+# Indexes ensured at every connect, by collection. create_indexes is a no-op
+# for indexes that already exist with the same keys and options.
+INDEX_MANIFEST: Dict[str, List[IndexModel]] = {
+    "tv": _catalog_indexes(),
+    "movie": _catalog_indexes(),
+    "files": [
+        IndexModel([("chat_id", ASCENDING), ("msg_id", ASCENDING)], name="chat_msg_unique", unique=True),
+    ],
+    "auth_users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+}
+
+# Hot queries whose plans are checked after the indexes are built:
+# (collection, filter, sort).
+QUERY_PROBES: List[Tuple[str, dict, Optional[List[Tuple[str, int]]]]] = [
+    *[
+        probe
+        for name in ("tv", "movie")
+        for probe in (
+            (name, {"tmdb_id": 0}, None),
+            (name, {"$or": [{"tmdb_id": 0}, {"title": "", "release_year": 0}]}, None),
+            # the default /api listing sort, and the homepage ones
+            (name, {}, _listing_sort([("rating", "desc")])),
+            (name, {}, _listing_sort([("rating", "desc"), ("release_year", "desc")])),
+            (name, {}, _listing_sort([("updated_on", "desc")])),
+            (name, {"genres": {"$in": [""]}}, [("rating", DESCENDING)]),
+            (name, {"search_prefixes": {"$all": ["probe"]}}, None),
+        )
+    ],
+    ("files", {"chat_id": 0, "msg_id": 0}, None),
+    ("auth_users", {"username": ""}, None),
+]
+
+
+def _plan_stages(plan) -> List[str]:
+    """every stage name in an explain() plan tree"""
+    if isinstance(plan, list):
+        return [stage for child in plan for stage in _plan_stages(child)]
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan["stage"]] if "stage" in plan else []
+    for value in plan.values():
+        if isinstance(value, (dict, list)):
+            stages.extend(_plan_stages(value))
+    return stages
+
+
+def _encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> list:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    # Only plain values: a dict here would become a query operator in _after.
+    if not isinstance(values, list) or not all(
+        value is None or isinstance(value, (bool, int, float, str, datetime, ObjectId)) for value in values
+    ):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def _after(sort_criteria: List[Tuple[str, int]], values: list) -> dict:
+    """
+    filter for documents strictly after `values` in sort_criteria order:
+    equal on the first i keys and past the cursor on key i, for every i
+    """
+    clauses = []
+    for i, (field, direction) in enumerate(sort_criteria):
+        clause = {prefix: value for (prefix, _), value in zip(sort_criteria[:i], values)}
+        clause[field] = {"$gt" if direction == ASCENDING else "$lt": values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+
+def _merge_qualities(target: List[dict], qualities: List[dict]) -> None:
+    for quality in qualities:
+        for index, existing_quality in enumerate(target):
+            if existing_quality["quality"] == quality["quality"]:
+                target[index] = quality
+                break
+        else:
+            target.append(quality)
+
+
+def _merge_media(documents: List[dict], kind: str) -> dict:
+    """
+    fold the media dicts of one title into the first, later files winning
+    a quality and setting languages and rip, as successive updates would
+    """
+    merged = documents[0]
+    for document in documents[1:]:
+        merged["languages"], merged["rip"] = document["languages"], document["rip"]
+        if kind == "movie":
+            merged["telegram"] = merged["telegram"] or []
+            _merge_qualities(merged["telegram"], document["telegram"] or [])
+            continue
+        for season in document["seasons"]:
+            target_season = next(
+                (s for s in merged["seasons"] if s["season_number"] == season["season_number"]), None)
+            if target_season is None:
+                merged["seasons"].append(season)
+                continue
+            for episode in season["episodes"]:
+                target_episode = next(
+                    (e for e in target_season["episodes"] if e["episode_number"] == episode["episode_number"]), None)
+                if target_episode is None:
+                    target_season["episodes"].append(episode)
+                    continue
+                target_episode["telegram"] = target_episode["telegram"] or []
+                _merge_qualities(target_episode["telegram"], episode["telegram"] or [])
+    return merged
+
+
+def _merge_updates(document: dict, stored: dict, kind: str, touched: dict) -> List[UpdateOne]:
+    """
+    UpdateOnes bringing the `stored` skeleton (qualities, episode and season
+    numbers) up to date with the merged `document`: $set for qualities it
+    already has, one guarded $push $each per episode, season and show for
+    what is new. No two touch the same array, so they can run unordered.
+    """
+    ops = []
+
+    def update(query: dict, change: dict, array_filters: Optional[List[dict]] = None) -> None:
+        change = {**change, "$set": {**change.get("$set", {}), **touched}}
+        ops.append(UpdateOne({"_id": stored["_id"], **query}, change, array_filters=array_filters))
+
+    if kind == "movie":
+        have = {q["quality"] for q in stored.get("telegram") or []}
+        new = []
+        for quality in document["telegram"] or []:
+            if quality["quality"] in have:
+                update({}, {"$set": {"telegram.$[q]": quality}}, [{"q.quality": quality["quality"]}])
+            else:
+                new.append(quality)
+        if new:
+            update({"telegram.quality": {"$nin": [q["quality"] for q in new]}},
+                   {"$push": {"telegram": {"$each": new}}})
+        return ops
+
+    stored_seasons = {s["season_number"]: s for s in stored.get("seasons") or []}
+    new_seasons = []
+    for season in document["seasons"]:
+        season_number = season["season_number"]
+        stored_season = stored_seasons.get(season_number)
+        if stored_season is None:
+            new_seasons.append(season)
+            continue
+        in_season = [{"s.season_number": season_number}]
+        stored_episodes = {e["episode_number"]: e for e in stored_season.get("episodes") or []}
+        new_episodes = []
+        for episode in season["episodes"]:
+            episode_number = episode["episode_number"]
+            stored_episode = stored_episodes.get(episode_number)
+            if stored_episode is None:
+                new_episodes.append(episode)
+                continue
+            in_episode = in_season + [{"e.episode_number": episode_number}]
+            have = {q["quality"] for q in stored_episode.get("telegram") or []}
+            new = []
+            for quality in episode["telegram"] or []:
+                if quality["quality"] in have:
+                    update({}, {"$set": {"seasons.$[s].episodes.$[e].telegram.$[q]": quality}},
+                           in_episode + [{"q.quality": quality["quality"]}])
+                else:
+                    new.append(quality)
+            if new:
+                update({"seasons": {"$elemMatch": {"season_number": season_number, "episodes": {"$elemMatch": {
+                           "episode_number": episode_number,
+                           "telegram.quality": {"$nin": [q["quality"] for q in new]}}}}}},
+                       {"$push": {"seasons.$[s].episodes.$[e].telegram": {"$each": new}}}, in_episode)
+        if new_episodes:
+            update({"seasons": {"$elemMatch": {
+                       "season_number": season_number,
+                       "episodes.episode_number": {"$nin": [e["episode_number"] for e in new_episodes]}}}},
+                   {"$push": {"seasons.$[s].episodes": {"$each": new_episodes}}}, in_season)
+    if new_seasons:
+        update({"seasons.season_number": {"$nin": [s["season_number"] for s in new_seasons]}},
+               {"$push": {"seasons": {"$each": new_seasons}}})
+    return ops
+
+
 class Database:
+    # Seconds a cached collection count is trusted when no write invalidated it.
+    COUNT_TTL = 300
+
     def __init__(self, connection_uri: str = Telegram.DATABASE, db_name: str = "projectS"):
         self._conn = None
         self.db = None
         self.tv_collection = None
         self.movie_collection = None
         self.deploy_config = None
+        self.files_collection = None
         self.connection_uri = connection_uri
         self.db_name = db_name
+        self.counts: Dict[str, Tuple[float, int]] = {}
 
     async def connect(self):
         """Establish a connection to the database."""
@@ -35,8 +317,13 @@ class Database:
             self.tv_collection = self.db["tv"]
             self.movie_collection = self.db["movie"]
             self.deploy_config = self.db["deploy_config"]  
+            self.files_collection = self.db["files"]
 
             LOGGER.info("Database connection established")
+            try:
+                await self.ensure_indexes()
+            except Exception as e:
+                LOGGER.error(f"Error ensuring indexes: {e}")
         
             # Debug: Print available collections
            # collections = await self.db.list_collection_names()
@@ -48,6 +335,95 @@ class Database:
             self.db = None
         
 
+    async def ensure_indexes(self) -> None:
+        """Apply INDEX_MANIFEST, then warn about hot queries still planned as COLLSCAN."""
+        reporter = asyncio.create_task(self._report_index_builds())
+        try:
+            for name, indexes in INDEX_MANIFEST.items():
+                started = monotonic()
+                failed = 0
+                # One index per call, so a failing build only loses that index
+                for index in indexes:
+                    try:
+                        await self.db[name].create_indexes([index])
+                    except OperationFailure as e:
+                        # e.g. duplicate tmdb_ids blocking a unique index, or an
+                        # older index with the same keys and other options
+                        failed += 1
+                        LOGGER.error(f"Failed to create index {index.document['name']} on {name}: {e}")
+                LOGGER.info(
+                    f"Indexes on {name} ready in {monotonic() - started:.1f}s"
+                    + (f" ({failed} of {len(indexes)} failed)" if failed else "")
+                )
+        finally:
+            reporter.cancel()
+        for name in ("tv", "movie"):
+            try:
+                await self._backfill_search_prefixes(self.db[name])
+            except Exception as e:
+                LOGGER.error(f"Failed to backfill search prefixes on {name}: {e}")
+        await self.check_query_plans()
+
+    @staticmethod
+    async def _backfill_search_prefixes(collection, batch_size: int = 500) -> None:
+        """Give documents stored before search_prefixes existed their word prefixes."""
+        ops, done = [], 0
+        async for doc in collection.find(
+            {"search_prefixes": {"$exists": False}},
+            {"title": 1, "telegram.name": 1, "seasons.episodes.telegram.name": 1}
+        ):
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": _search_fields(doc)}))
+            if len(ops) == batch_size:
+                await collection.bulk_write(ops, ordered=False)
+                done += len(ops)
+                ops = []
+        if ops:
+            await collection.bulk_write(ops, ordered=False)
+            done += len(ops)
+        if done:
+            LOGGER.info(f"Backfilled search prefixes of {done} documents in {collection.name}")
+
+    async def _report_index_builds(self, interval: float = 5) -> None:
+        """Log progress of running index builds; needs the inprog privilege."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                ops = await self._conn.admin.aggregate([
+                    {"$currentOp": {}},
+                    {"$match": {"command.createIndexes": {"$exists": True}}}
+                ]).to_list(None)
+            except Exception:
+                return
+            for op in ops:
+                progress = op.get("progress", {})
+                LOGGER.info(
+                    f"Building indexes on {op['command']['createIndexes']}: "
+                    f"{op.get('msg', 'in progress')} ({progress.get('done', 0)}/{progress.get('total', '?')})"
+                )
+
+    async def check_query_plans(self) -> List[str]:
+        """
+        Explain QUERY_PROBES and return (and log) the ones that scan the
+        whole collection or sort in memory.
+        """
+        scans = []
+        for name, query, sort in QUERY_PROBES:
+            cursor = self.db[name].find(query).limit(20)
+            if sort:
+                cursor = cursor.sort(sort)
+            try:
+                plan = await cursor.explain()
+            except OperationFailure as e:
+                LOGGER.warning(f"Could not explain query on {name}: {e}")
+                continue
+            stages = _plan_stages(plan.get("queryPlanner", {}).get("winningPlan", {}))
+            for stage in ("COLLSCAN", "SORT"):
+                if stage in stages:
+                    scans.append(f"{stage}: {name} {query} sort={sort}")
+        for scan in scans:
+            LOGGER.warning(f"Query plan still uses {scan}")
+        return scans
+
     async def disconnect(self):
         """Close the database connection."""
         if self._conn is not None:
@@ -57,6 +433,7 @@ class Database:
         self.db = None
         self.tv_collection = None
         self.movie_collection = None
+        self.files_collection = None
 
     @staticmethod
     def _convert_object_id(document: dict) -> dict:
@@ -66,6 +443,87 @@ class Database:
         return document
 
     
+    async def _find_or_insert(self, collection, media_dict: dict) -> Tuple[ObjectId, bool]:
+        """
+        _id of the document matching media_dict by tmdb_id (or title and
+        release year), inserting media_dict when there is none; the bool
+        is True when it was inserted
+        """
+        existing_media = await collection.find_one({
+            "$or": [
+                {"tmdb_id": media_dict["tmdb_id"]},
+                {"title": media_dict["title"], "release_year": media_dict["release_year"]}
+            ]
+        }, {"_id": 1})
+        if existing_media:
+            return existing_media["_id"], False
+        try:
+            result = await collection.insert_one(media_dict)
+        except DuplicateKeyError:
+            # another worker inserted the same tmdb_id since the lookup
+            existing_media = await collection.find_one({"tmdb_id": media_dict["tmdb_id"]}, {"_id": 1})
+            return existing_media["_id"], False
+        self.counts.pop(collection.name, None)
+        return result.inserted_id, True
+
+    @staticmethod
+    async def _apply_first(collection, media_id: ObjectId, steps: list, touched: dict) -> bool:
+        """
+        Run the first of `steps` whose guard matches the document, as one
+        atomic update_one that also $sets `touched`. The guards are mutually
+        exclusive, so when a concurrent write makes none match the steps
+        are simply tried again.
+        """
+        for _ in range(3):
+            for query, update, array_filters in steps:
+                update = {**update, "$set": {**update.get("$set", {}), **touched}}
+                result = await collection.update_one(
+                    {"_id": media_id, **query}, update, array_filters=array_filters)
+                if result.matched_count:
+                    return True
+        return False
+
+    @staticmethod
+    def _episode_steps(season: dict, episode: dict, quality: dict) -> list:
+        """update_one steps merging one quality of one episode into a show"""
+        season_number, episode_number = season["season_number"], episode["episode_number"]
+        new_episode = {**episode, "telegram": [quality]}
+        in_season = [{"s.season_number": season_number}]
+        in_episode = in_season + [{"e.episode_number": episode_number}]
+        return [
+            # replace the episode's file of the same quality
+            ({"seasons": {"$elemMatch": {"season_number": season_number, "episodes": {"$elemMatch": {
+                "episode_number": episode_number, "telegram.quality": quality["quality"]}}}}},
+             {"$set": {"seasons.$[s].episodes.$[e].telegram.$[q]": quality}},
+             in_episode + [{"q.quality": quality["quality"]}]),
+            # add the quality to the episode
+            ({"seasons": {"$elemMatch": {"season_number": season_number, "episodes": {"$elemMatch": {
+                "episode_number": episode_number, "telegram.quality": {"$ne": quality["quality"]}}}}}},
+             {"$push": {"seasons.$[s].episodes.$[e].telegram": quality}},
+             in_episode),
+            # add the episode to the season
+            ({"seasons": {"$elemMatch": {
+                "season_number": season_number, "episodes.episode_number": {"$ne": episode_number}}}},
+             {"$push": {"seasons.$[s].episodes": new_episode}},
+             in_season),
+            # add the season
+            ({"seasons.season_number": {"$ne": season_number}},
+             {"$push": {"seasons": {**season, "episodes": [new_episode]}}},
+             None),
+        ]
+
+    @staticmethod
+    def _movie_steps(quality: dict) -> list:
+        """update_one steps merging one quality into a movie"""
+        return [
+            ({"telegram.quality": quality["quality"]},
+             {"$set": {"telegram.$[q]": quality}},
+             [{"q.quality": quality["quality"]}]),
+            ({"telegram.quality": {"$ne": quality["quality"]}},
+             {"$push": {"telegram": quality}},
+             None),
+        ]
+
     async def update_tv_show(self, tv_show_data: TVShowSchema) -> Optional[ObjectId]:
         try:
             tv_show_dict = tv_show_data.dict()
@@ -73,58 +531,27 @@ class Database:
             LOGGER.error(f"Validation error: {e}")
             return None
 
-        existing_media = await self.tv_collection.find_one({
-            "$or": [
-                {"tmdb_id": tv_show_dict["tmdb_id"]},
-                {"title": tv_show_dict["title"], "release_year": tv_show_dict["release_year"]}
-            ]
-        })
-
-        if not existing_media:
-            result = await self.tv_collection.insert_one(tv_show_dict)
-            return result.inserted_id
+        tv_show_dict.update(_search_fields(tv_show_dict))
+        media_id, inserted = await self._find_or_insert(self.tv_collection, tv_show_dict)
+        if inserted:
+            return media_id
 
-        updated = False
+        touched = {
+            "updated_on": datetime.utcnow(),
+            "languages": tv_show_dict["languages"],
+            "rip": tv_show_dict["rip"]
+        }
         for season in tv_show_dict["seasons"]:
-            existing_season = next(
-                (s for s in existing_media["seasons"] 
-                 if s["season_number"] == season["season_number"]), None)
-            
-            if existing_season:
-                for episode in season["episodes"]:
-                    existing_episode = next(
-                        (e for e in existing_season["episodes"] 
-                         if e["episode_number"] == episode["episode_number"]), None)
-                    
-                    if existing_episode:
-                        for quality in episode["telegram"]:
-                            existing_quality = next(
-                                (q for q in existing_episode["telegram"] 
-                                 if q["quality"] == quality["quality"]), None)
-                            
-                            if existing_quality:
-                                existing_quality.update(quality)
-                                updated = True
-                            else:
-                                existing_episode["telegram"].append(quality)
-                                updated = True
-                    else:
-                        existing_season["episodes"].append(episode)
-                        updated = True
-            else:
-                existing_media["seasons"].append(season)
-                updated = True
-
-        if updated:
-            existing_media["updated_on"] = datetime.utcnow()
-            existing_media["languages"] = tv_show_dict["languages"]
-            existing_media["rip"] = tv_show_dict["rip"]
-            await self.tv_collection.replace_one(
-                {"tmdb_id": tv_show_dict["tmdb_id"]}, existing_media)
-            return existing_media["_id"]
-        else:
-            LOGGER.info(f"No updates made for: {tv_show_dict['tmdb_id']}")
-            return existing_media["_id"]
+            for episode in season["episodes"]:
+                for quality in episode["telegram"] or []:
+                    steps = self._episode_steps(season, episode, quality)
+                    if not await self._apply_first(self.tv_collection, media_id, steps, touched):
+                        LOGGER.warning(
+                            f"Could not merge S{season['season_number']}E{episode['episode_number']} "
+                            f"{quality['quality']} into {tv_show_dict['tmdb_id']}"
+                        )
+        await self.tv_collection.update_one({"_id": media_id}, _add_search_prefixes(tv_show_dict))
+        return media_id
 
     async def update_movie(self, movie_data: MovieSchema) -> Optional[ObjectId]:
         if self.movie_collection is None:
@@ -136,40 +563,21 @@ class Database:
             LOGGER.error(f"Validation error: {e}")
             return None
 
-        existing_media = await self.movie_collection.find_one({
-            "$or": [
-                {"tmdb_id": movie_dict["tmdb_id"]},
-                {"title": movie_dict["title"], "release_year": movie_dict["release_year"]}
-            ]
-        })
+        movie_dict.update(_search_fields(movie_dict))
+        media_id, inserted = await self._find_or_insert(self.movie_collection, movie_dict)
+        if inserted:
+            return media_id
 
-        if not existing_media:
-            result = await self.movie_collection.insert_one(movie_dict)
-            return result.inserted_id
-
-        updated = False
-        for quality in movie_dict["telegram"]:
-            existing_quality = next(
-                (q for q in existing_media["telegram"] 
-                 if q["quality"] == quality["quality"]), None)
-            
-            if existing_quality:
-                existing_quality.update(quality)
-                updated = True
-            else:
-                existing_media["telegram"].append(quality)
-                updated = True
-
-        if updated:
-            existing_media["updated_on"] = datetime.utcnow()
-            existing_media["languages"] = movie_dict["languages"]
-            existing_media["rip"] = movie_dict["rip"]
-            await self.movie_collection.replace_one(
-                {"tmdb_id": movie_dict["tmdb_id"]}, existing_media)
-            return existing_media["_id"]
-        else:
-            LOGGER.info(f"No updates made for: {movie_dict['tmdb_id']}")
-            return existing_media["_id"]
+        touched = {
+            "updated_on": datetime.utcnow(),
+            "languages": movie_dict["languages"],
+            "rip": movie_dict["rip"]
+        }
+        for quality in movie_dict["telegram"] or []:
+            if not await self._apply_first(self.movie_collection, media_id, self._movie_steps(quality), touched):
+                LOGGER.warning(f"Could not merge {quality['quality']} into {movie_dict['tmdb_id']}")
+        await self.movie_collection.update_one({"_id": media_id}, _add_search_prefixes(movie_dict))
+        return media_id
 
     async def insert_media(
         self,
@@ -180,6 +588,20 @@ class Database:
         size: str,
         name: str
     ) -> Optional[ObjectId]:
+        media = await self.build_media(metadata_info, hash, channel, msg_id, size, name)
+        if isinstance(media, MovieSchema):
+            return await self.update_movie(media)
+        return await self.update_tv_show(media)
+
+    @staticmethod
+    async def build_media(
+        metadata_info: dict,
+        hash: str,
+        channel: int,
+        msg_id: int,
+        size: str,
+        name: str
+    ) -> Union[MovieSchema, TVShowSchema]:
         data = {"chat_id": channel, "msg_id": msg_id, "hash": hash}
         encoded_string = await encode_string(data)
 
@@ -205,7 +627,7 @@ class Database:
                         size=size
                     )]
             )
-            return await self.update_movie(media)
+            return media
         else:
             tv_show = TVShowSchema(
                 tmdb_id=metadata_info['tmdb_id'],
@@ -243,53 +665,198 @@ class Database:
                     )
                 ]
             )
-            return await self.update_tv_show(tv_show)
+            return tv_show
+
+    async def insert_media_batch(self, items: List[dict]) -> List[Union[ObjectId, Exception, None]]:
+        """
+        insert_media for many files at once. Files of the same title are
+        merged in memory and diffed against the stored document's seasons,
+        episodes and qualities, so each collection gets one unordered
+        bulk_write. Returns, per item, the document _id or the exception
+        the item failed with.
+        """
+        results: List[Union[ObjectId, Exception, None]] = [None] * len(items)
+        media: List[Optional[dict]] = [None] * len(items)
+        groups: Dict[Tuple[str, int], List[int]] = {}
+        for index, item in enumerate(items):
+            try:
+                media[index] = (await self.build_media(**item)).dict()
+            except Exception as e:
+                results[index] = e
+                continue
+            kind = "movie" if item["metadata_info"]["media_type"] == "movie" else "tv"
+            groups.setdefault((kind, media[index]["tmdb_id"]), []).append(index)
+
+        for kind, collection in (("movie", self.movie_collection), ("tv", self.tv_collection)):
+            kind_groups = {tmdb_id: indexes for (k, tmdb_id), indexes in groups.items() if k == kind}
+            if kind_groups:
+                await self._bulk_merge(collection, kind, kind_groups, media, items, results)
+        return results
+
+    async def _bulk_merge(
+        self,
+        collection,
+        kind: str,
+        groups: Dict[int, List[int]],
+        media: List[Optional[dict]],
+        items: List[dict],
+        results: list
+    ) -> None:
+        merged = {tmdb_id: _merge_media([media[i] for i in indexes], kind) for tmdb_id, indexes in groups.items()}
+        existing = {}
+        async for doc in collection.find(
+            {"$or": [{"tmdb_id": {"$in": list(groups)}}] + [
+                {"title": m["title"], "release_year": m["release_year"]} for m in merged.values()
+            ]},
+            {"tmdb_id": 1, "title": 1, "release_year": 1, "telegram.quality": 1, "seasons.season_number": 1,
+             "seasons.episodes.episode_number": 1, "seasons.episodes.telegram.quality": 1}
+        ):
+            existing.setdefault(doc.get("tmdb_id"), doc)
+            existing.setdefault((doc.get("title"), doc.get("release_year")), doc)
+
+        ops, op_groups, group_ids = [], [], {}
+        touched_at = datetime.utcnow()
+        for tmdb_id, document in merged.items():
+            doc = existing.get(tmdb_id) or existing.get((document["title"], document["release_year"]))
+            if doc is None:
+                document["_id"] = group_ids[tmdb_id] = ObjectId()
+                document.update(_search_fields(document))
+                ops.append(InsertOne(document))
+                op_groups.append(tmdb_id)
+                continue
+            group_ids[tmdb_id] = doc["_id"]
+            touched = {"updated_on": touched_at, "languages": document["languages"], "rip": document["rip"]}
+            for op in _merge_updates(document, doc, kind, touched):
+                ops.append(op)
+                op_groups.append(tmdb_id)
+            ops.append(UpdateOne({"_id": doc["_id"]}, _add_search_prefixes(document)))
+            op_groups.append(tmdb_id)
+
+        # Groups whose writes failed or whose guards no longer matched (a
+        # concurrent write) are replayed file by file through insert_media,
+        # whose steps are idempotent.
+        replay = set()
+        # UpdateOnes that ran without a write error; each must have matched
+        updates = sum(isinstance(op, UpdateOne) for op in ops)
+        try:
+            result = await collection.bulk_write(ops, ordered=False)
+            matched, inserted = result.matched_count, result.inserted_count
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                replay.add(op_groups[error["index"]])
+                updates -= isinstance(ops[error["index"]], UpdateOne)
+            matched, inserted = e.details.get("nMatched", 0), e.details.get("nInserted", 0)
+        if matched < updates:
+            # which guard missed is unknown, so every updated group is replayed
+            replay.update(tmdb_id for op, tmdb_id in zip(ops, op_groups) if isinstance(op, UpdateOne))
+        if inserted:
+            self.counts.pop(collection.name, None)
+
+        for tmdb_id, indexes in groups.items():
+            for index in indexes:
+                if tmdb_id not in replay:
+                    results[index] = group_ids[tmdb_id]
+                    continue
+                try:
+                    results[index] = await self.insert_media(**items[index])
+                except Exception as e:
+                    results[index] = e
+
+    async def save_file_ids(self, chat_id: int, msg_id: int, record: dict) -> None:
+        """Persist the decoded FileId fields of a Telegram message."""
+        if self.files_collection is None:
+            return
+        record = {**record, "chat_id": chat_id, "msg_id": msg_id, "updated_on": datetime.utcnow()}
+        await self.files_collection.update_one(
+            {"chat_id": chat_id, "msg_id": msg_id}, {"$set": record}, upsert=True
+        )
+
+    async def save_file_media(self, chat_id: int, msg_id: int, metadata_info: dict) -> None:
+        """Link a stored file to the title, episode and quality it was ingested as."""
+        if self.files_collection is None:
+            return
+        await self.files_collection.update_one(
+            {"chat_id": chat_id, "msg_id": msg_id},
+            {"$set": {
+                "tmdb_id": metadata_info["tmdb_id"],
+                "quality": metadata_info["quality"],
+                "season_number": metadata_info.get("season_number"),
+                "episode_number": metadata_info.get("episode_number"),
+            }},
+            upsert=True
+        )
+
+    async def get_file_record(self, chat_id: int, msg_id: int) -> Optional[dict]:
+        if self.files_collection is None:
+            return None
+        return await self.files_collection.find_one({"chat_id": chat_id, "msg_id": msg_id}, {"_id": 0})
+
+    async def total_count(self, collection) -> int:
+        """
+        estimated_document_count of a collection, cached until the next
+        insert or delete through this instance (or COUNT_TTL)
+        """
+        cached = self.counts.get(collection.name)
+        if cached and cached[0] > monotonic():
+            return cached[1]
+        count = await collection.estimated_document_count()
+        self.counts[collection.name] = (monotonic() + self.COUNT_TTL, count)
+        return count
+
+    async def _sorted_page(
+        self,
+        collection,
+        sort_params: List[Tuple[str, str]],
+        page: int,
+        page_size: int,
+        cursor: Optional[str]
+    ) -> Tuple[List[dict], Optional[str], int]:
+        """
+        One page of `collection` in sort_params order, completed by
+        _listing_sort so ties are broken by index keys and _id.
+        With a cursor the page starts right after it via an index seek;
+        without one `page` is skipped to. Returns the documents, the cursor
+        for the next page (None on the last one) and the cached total count.
+        """
+        sort_criteria = _listing_sort(sort_params)
+
+        if cursor:
+            values = _decode_cursor(cursor)
+            if len(values) != len(sort_criteria):
+                raise ValueError("Cursor does not match sort_by")
+            query = collection.find(_after(sort_criteria, values), SEARCH_FIELDS)
+        else:
+            query = collection.find({}, SEARCH_FIELDS).skip((page - 1) * page_size)
+
+        docs = await query.sort(sort_criteria).limit(page_size).to_list(page_size)
+        next_cursor = None
+        if len(docs) == page_size:
+            next_cursor = _encode_cursor([docs[-1].get(field) for field, _ in sort_criteria])
+        return docs, next_cursor, await self.total_count(collection)
 
     async def sort_tv_shows(
         self, 
         sort_params: List[Tuple[str, str]], 
         page: int, 
-        page_size: int
+        page_size: int,
+        cursor: Optional[str] = None
     ) -> dict:
-        skip = (page - 1) * page_size
-        sort_criteria = [(field, ASCENDING if direction == "asc" else DESCENDING) 
-                        for field, direction in sort_params]
-        
-        pipeline = [
-            {"$sort": dict(sort_criteria)},
-            {"$facet": {
-                "metadata": [{"$count": "total_count"}],
-                "data": [{"$skip": skip}, {"$limit": page_size}]
-            }}
-        ]
-        
-        result = await self.tv_collection.aggregate(pipeline).to_list(1)
-        total_count = result[0]["metadata"][0]["total_count"] if result[0]["metadata"] else 0
-        sorted_shows = [TVShowSchema(**doc) for doc in result[0]["data"]]
-        return {"total_count": total_count, "tv_shows": sorted_shows}
+        docs, next_cursor, total_count = await self._sorted_page(
+            self.tv_collection, sort_params, page, page_size, cursor)
+        sorted_shows = [TVShowSchema(**doc) for doc in docs]
+        return {"total_count": total_count, "tv_shows": sorted_shows, "next_cursor": next_cursor}
 
     async def sort_movies(
         self, 
         sort_params: List[Tuple[str, str]], 
         page: int, 
-        page_size: int
+        page_size: int,
+        cursor: Optional[str] = None
     ) -> dict:
-        skip = (page - 1) * page_size
-        sort_criteria = [(field, ASCENDING if direction == "asc" else DESCENDING) 
-                        for field, direction in sort_params]
-        
-        pipeline = [
-            {"$sort": dict(sort_criteria)},
-            {"$facet": {
-                "metadata": [{"$count": "total_count"}],
-                "data": [{"$skip": skip}, {"$limit": page_size}]
-            }}
-        ]
-        
-        result = await self.movie_collection.aggregate(pipeline).to_list(1)
-        total_count = result[0]["metadata"][0]["total_count"] if result[0]["metadata"] else 0
-        sorted_movies = [MovieSchema(**doc) for doc in result[0]["data"]]
-        return {"total_count": total_count, "movies": sorted_movies}
+        docs, next_cursor, total_count = await self._sorted_page(
+            self.movie_collection, sort_params, page, page_size, cursor)
+        sorted_movies = [MovieSchema(**doc) for doc in docs]
+        return {"total_count": total_count, "movies": sorted_movies, "next_cursor": next_cursor}
 
     async def find_similar_media(
         self,
@@ -318,6 +885,7 @@ class Database:
                 "genreMatchCount": {"$size": {"$setIntersection": ["$genres", parent_genres]}}
             }},
             {"$sort": {"genreMatchCount": -1, "rating": -1}},
+            {"$project": SEARCH_FIELDS},
             {"$facet": {
                 "metadata": [{"$count": "total_count"}],
                 "data": [{"$skip": skip}, {"$limit": page_size}]
@@ -335,41 +903,65 @@ class Database:
         page: int, 
         page_size: int
     ) -> dict:
-        skip = (page - 1) * page_size
-        words = query.split()
-        regex_query = {'$regex': '.*' + '.*'.join(words) + '.*', '$options': 'i'}
-        
-        tv_pipeline = [
-            {"$match": {"$or": [
-                {"title": regex_query},
-                {"seasons.episodes.telegram.name": regex_query}
-            ]}},
-            {"$project": {
-                "_id": 1, "tmdb_id": 1, "title": 1, "genres": 1, "rating": 1,
-                "release_year": 1, "poster": 1, "backdrop": 1, "description": 1,
-                "total_seasons": 1, "total_episodes": 1, "media_type": 1
-            }}
-        ]
-        
-        movie_pipeline = [
-            {"$match": {"$or": [
-                {"title": regex_query},
-                {"telegram.name": regex_query}
-            ]}},
-            {"$project": {
-                "_id": 1, "tmdb_id": 1, "title": 1, "genres": 1, "rating": 1,
-                "release_year": 1, "poster": 1, "backdrop": 1, "description": 1,
-                "media_type": 1
+        """
+        Search titles and file names of both collections, ranked and
+        paginated in the database. Every typed word of SEARCH_MIN_LENGTH or
+        more characters must start a word of the title or a file name, so a
+        partly typed word still matches; the words are looked up in the
+        search_prefixes index, and documents whose title has them all
+        outrank file name matches.
+        """
+        words = list(dict.fromkeys(
+            word[:SEARCH_PREFIX_LENGTH] for word in _search_words(query) if len(word) >= SEARCH_MIN_LENGTH
+        ))
+        if not words:
+            return {"total_count": 0, "results": []}
+        match = {"search_prefixes": {"$all": words}}
+        title_score = {"$cond": [{"$setIsSubset": [words, {"$ifNull": ["$title_prefixes", []]}]}, 10, 1]}
+        return await self._search(match, title_score, (page - 1) * page_size, page_size)
+
+    async def _search(self, match: dict, score: dict, skip: int, limit: int) -> dict:
+        """
+        Rank the documents of both collections matching `match` by score
+        and _id, carrying only those keys through the sort, then load the
+        listed fields for the requested page alone.
+        """
+        def ranked(kind: str) -> List[dict]:
+            return [{"$match": match}, {"$project": {"_id": 1, "score": score, "kind": {"$literal": kind}}}]
+
+        pipeline = [
+            *ranked("tv"),
+            {"$unionWith": {"coll": self.movie_collection.name, "pipeline": ranked("movie")}},
+            {"$sort": {"score": -1, "_id": 1}},
+            {"$facet": {
+                "metadata": [{"$count": "total_count"}],
+                "data": [{"$skip": skip}, {"$limit": limit}]
             }}
         ]
-        
-        tv_results = await self.tv_collection.aggregate(tv_pipeline).to_list(None)
-        movie_results = await self.movie_collection.aggregate(movie_pipeline).to_list(None)
-        combined = tv_results + movie_results
-        
+        result = await self.tv_collection.aggregate(pipeline).to_list(1)
+        total_count = result[0]["metadata"][0]["total_count"] if result[0]["metadata"] else 0
+        page = result[0]["data"]
+
+        fields = {
+            "_id": 1, "tmdb_id": 1, "title": 1, "genres": 1, "rating": 1,
+            "release_year": 1, "poster": 1, "backdrop": 1, "description": 1,
+            "media_type": 1
+        }
+        docs = {}
+        for kind, collection, extra in (
+            ("tv", self.tv_collection, {"total_seasons": 1, "total_episodes": 1}),
+            ("movie", self.movie_collection, {}),
+        ):
+            ids = [hit["_id"] for hit in page if hit["kind"] == kind]
+            if ids:
+                async for doc in collection.find({"_id": {"$in": ids}}, {**fields, **extra}):
+                    docs[(kind, doc["_id"])] = doc
         return {
-            "total_count": len(combined),
-            "results": [self._convert_object_id(doc) for doc in combined[skip:skip+page_size]]
+            "total_count": total_count,
+            "results": [
+                self._convert_object_id(docs[(hit["kind"], hit["_id"])])
+                for hit in page if (hit["kind"], hit["_id"]) in docs
+            ]
         }
 
     async def get_media_details(
@@ -413,13 +1005,13 @@ class Database:
             return None
 
         else:
-            tv_doc = await self.tv_collection.find_one({"tmdb_id": tmdb_id})
+            tv_doc = await self.tv_collection.find_one({"tmdb_id": tmdb_id}, SEARCH_FIELDS)
             if tv_doc:
                 tv_doc = self._convert_object_id(tv_doc)
                 tv_doc["type"] = "tv"
                 return tv_doc
             
-            movie_doc = await self.movie_collection.find_one({"tmdb_id": tmdb_id})
+            movie_doc = await self.movie_collection.find_one({"tmdb_id": tmdb_id}, SEARCH_FIELDS)
             if movie_doc:
                 movie_doc = self._convert_object_id(movie_doc)
                 movie_doc["type"] = "movie"
@@ -485,6 +1077,7 @@ class Database:
             result = await self.tv_collection.delete_one({"tmdb_id": tmdb_id})
         
         if result.deleted_count > 0:
+            self.counts.clear()
             LOGGER.info(f"{media_type} with tmdb_id {tmdb_id} deleted successfully.")
             return True
         LOGGER.info(f"No document found with tmdb_id {tmdb_id}.")
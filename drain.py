@@ -0,0 +1,55 @@
+import asyncio
+from time import monotonic
+from typing import List
+from Backend.logger import LOGGER
+from Backend.config import Telegram
+from Backend.helper.admission import admission
+from Backend.helper.chunk_cache import chunk_cache
+from Backend.helper.prefetch import prefetcher
+
+
+class Drainer:
+    """
+    Wind the server down before a restart or shutdown: refuse new /dl
+    requests with 503 + Retry-After, give active streams and the watched
+    work queues until the deadline to finish, then flush the chunk cache.
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.queues: List[asyncio.Queue] = []
+
+    def watch(self, queue: asyncio.Queue) -> None:
+        self.queues.append(queue)
+
+    async def drain(self) -> None:
+        if admission.draining:
+            return
+        admission.draining = True
+        deadline = monotonic() + self.timeout
+        prefetcher.stop()
+
+        LOGGER.info(f"Draining {admission.active} active streams (up to {self.timeout:.0f}s)...")
+        if not await admission.wait_idle(self.timeout):
+            LOGGER.warning(f"Drain deadline reached with {admission.active} streams still active")
+
+        for queue in self.queues:
+            try:
+                await asyncio.wait_for(queue.join(), max(deadline - monotonic(), 0.1))
+            except asyncio.TimeoutError:
+                LOGGER.warning(f"Drain deadline reached with {queue.qsize()} queued items left")
+
+        await chunk_cache.flush()
+        LOGGER.info("Drain complete")
+
+    def resume(self) -> None:
+        """
+        undo drain() when the restart or shutdown it prepared for fails;
+        the prefetcher restarts on its next schedule()
+        """
+        if admission.draining:
+            admission.draining = False
+            LOGGER.info("Drain cancelled, accepting streams again")
+
+
+drainer = Drainer(Telegram.DRAIN_TIMEOUT)
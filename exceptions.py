@@ -3,4 +3,10 @@ class InvalidHash(Exception):
 
 
 class FIleNotFound(Exception):
-    message = 'File not found!'
\ No newline at end of file
+    message = 'File not found!'
+
+class RangeNotSatisfiable(Exception):
+    message = 'Range not satisfiable!'
+
+class CdnUnavailable(Exception):
+    message = 'CDN download unavailable!'
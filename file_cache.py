@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from pyrogram.file_id import FileId, FileType
+from Backend.config import Telegram
+from Backend.helper.singleflight import SingleFlight
+
+
+class FileEntry:
+    def __init__(self, ttl: float):
+        self.expires = monotonic() + ttl
+        # FileId resolved by each client index
+        self.file_ids: Dict[int, FileId] = {}
+
+
+class FilePropertiesCache:
+    """
+    Process-wide cache of FileIds keyed by (chat_id, message_id), with a
+    per-entry TTL, LRU eviction past max_size and single-flight on misses.
+    Document and photo FileIds carry no per-bot peer data, so with `share`
+    enabled one client's lookup serves every client.
+    """
+
+    def __init__(self, max_size: int, ttl: float, share: bool = True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.share = share
+        self.entries: "OrderedDict[Tuple[int, int], FileEntry]" = OrderedDict()
+        self.flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+
+    def _shareable(self, file_id: FileId) -> bool:
+        return self.share and file_id.file_type != FileType.CHAT_PHOTO
+
+    def _lookup(self, index: int, key: Tuple[int, int]) -> Optional[FileId]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= monotonic():
+            del self.entries[key]
+            return None
+        file_id = entry.file_ids.get(index)
+        if file_id is None:
+            file_id = next((f for f in entry.file_ids.values() if self._shareable(f)), None)
+        if file_id is not None:
+            self.entries.move_to_end(key)
+        return file_id
+
+    def _store(self, index: int, key: Tuple[int, int], file_id: FileId) -> None:
+        entry = self.entries.get(key)
+        if entry is None or entry.expires <= monotonic():
+            entry = self.entries[key] = FileEntry(self.ttl)
+        entry.file_ids[index] = file_id
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get(self, index: int, chat_id: int, message_id: int, loader: Callable[[], Awaitable[FileId]]) -> FileId:
+        key = (int(chat_id), int(message_id))
+        file_id = self._lookup(index, key)
+        if file_id is not None:
+            self.hits += 1
+            return file_id
+        self.misses += 1
+
+        async def load() -> FileId:
+            file_id = await loader()
+            self._store(index, key, file_id)
+            return file_id
+
+        flight_key = key if self.share else (index, *key)
+        return await self.flights.do(flight_key, load)
+
+    def dc_of(self, chat_id: int, message_id: int) -> Optional[int]:
+        """
+        DC of a cached file, without touching hit counters or recency
+        """
+        entry = self.entries.get((int(chat_id), int(message_id)))
+        if entry is None or not entry.file_ids:
+            return None
+        return next(iter(entry.file_ids.values())).dc_id
+
+    def invalidate(self, chat_id: int, message_id: int) -> None:
+        self.entries.pop((int(chat_id), int(message_id)), None)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+file_cache = FilePropertiesCache(Telegram.FILE_CACHE_SIZE, Telegram.FILE_CACHE_TTL, Telegram.SHARE_FILE_IDS)
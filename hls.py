@@ -0,0 +1,93 @@
+import math
+from collections import OrderedDict
+from typing import List, NamedTuple
+from pyrogram.file_id import FileId
+from Backend.config import Telegram
+
+# Segments are sized in Telegram's 1 MB parts, so segment requests map onto
+# (nearly) whole GetFile parts and chunk cache entries.
+PART_SIZE = 1024 * 1024
+# HLS players (hls.js, Safari) only take MPEG-TS or fMP4 segments. MPEG-TS
+# is the one that can be cut at any packet boundary; fMP4 needs an init
+# segment and fragment-aligned cuts, and MKV or plain MP4 are not HLS formats.
+TS_PACKET_SIZE = 188
+TS_MIME_TYPES = {"video/mp2t", "video/mpeg-ts"}
+TS_EXTENSIONS = (".ts", ".mts")
+
+
+def is_segmentable(file_id: FileId) -> bool:
+    """whether the file is MPEG-TS, the only container served as HLS"""
+    mime_type = (getattr(file_id, "mime_type", None) or "").lower()
+    file_name = (getattr(file_id, "file_name", None) or "").lower()
+    return mime_type in TS_MIME_TYPES or file_name.endswith(TS_EXTENSIONS)
+
+
+class Segment(NamedTuple):
+    offset: int
+    length: int
+    duration: float
+
+
+class SegmentIndex:
+    """
+    Byte-range segment lists keyed by unique_id. A file never changes under
+    its unique_id, so an index is computed once and kept until evicted.
+    """
+
+    def __init__(self, segment_size: int, segment_seconds: float, max_size: int = 1024):
+        self.segment_size = max(PART_SIZE, segment_size - segment_size % PART_SIZE)
+        self.segment_seconds = segment_seconds
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, List[Segment]]" = OrderedDict()
+
+    def build(self, file_size: int, duration: float) -> List[Segment]:
+        """
+        split the file into pieces of about segment_size, each starting on a
+        TS packet; with a known duration each piece is given its share of
+        it, assuming a roughly constant bitrate
+        """
+        boundaries = [
+            offset - offset % TS_PACKET_SIZE for offset in range(0, file_size, self.segment_size)
+        ] + [file_size]
+        segments = []
+        for offset, end in zip(boundaries, boundaries[1:]):
+            length = end - offset
+            if duration:
+                seconds = duration * length / file_size
+            else:
+                seconds = self.segment_seconds * length / self.segment_size
+            segments.append(Segment(offset, length, seconds))
+        return segments
+
+    def get(self, file_id: FileId) -> List[Segment]:
+        segments = self.entries.get(file_id.unique_id)
+        if segments is None:
+            segments = self.build(file_id.file_size, getattr(file_id, "duration", 0))
+            self.entries[file_id.unique_id] = segments
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        self.entries.move_to_end(file_id.unique_id)
+        return segments
+
+
+def render_playlist(segments: List[Segment], uri: str) -> str:
+    """
+    VOD media playlist addressing every segment as an EXT-X-BYTERANGE of uri
+    """
+    target = max((math.ceil(s.duration) for s in segments), default=1)
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:4",
+        f"#EXT-X-TARGETDURATION:{target}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for segment in segments:
+        lines.append(f"#EXTINF:{segment.duration:.3f},")
+        lines.append(f"#EXT-X-BYTERANGE:{segment.length}@{segment.offset}")
+        lines.append(uri)
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+segment_index = SegmentIndex(Telegram.HLS_SEGMENT_MB * PART_SIZE, Telegram.HLS_SEGMENT_SECONDS)
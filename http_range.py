@@ -0,0 +1,98 @@
+import re
+import secrets
+from typing import List, Optional, Tuple
+from Backend.helper.exceptions import RangeNotSatisfiable
+
+# More ranges than this in one request are treated as abuse and ignored.
+MAX_RANGES = 16
+# RFC 9110 positions are ASCII digits; str.isdigit() also takes "²", which int() rejects.
+DIGITS = re.compile(r"[0-9]+")
+
+
+def parse_range(range_header: Optional[str], file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a `Range: bytes=...` header into inclusive (start, end) pairs.
+    Supports `a-b`, open `a-` and suffix `-n` specs, and several of them
+    separated by commas; the result is sorted with overlapping or adjacent
+    ranges merged. Returns None when the whole file should be sent (no
+    header, another unit or malformed syntax) and raises
+    RangeNotSatisfiable when no range overlaps the file.
+    """
+    if not range_header:
+        return None
+    unit, _, specs = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs.strip():
+        return None
+    specs = [spec.strip() for spec in specs.split(",") if spec.strip()]
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        start, dash, end = spec.partition("-")
+        start, end = start.strip(), end.strip()
+        if not dash or (start and not DIGITS.fullmatch(start)) or (end and not DIGITS.fullmatch(end)) or not (start or end):
+            return None
+        if not start:
+            # Suffix range: the last `end` bytes.
+            length = int(end)
+            if length == 0 or file_size == 0:
+                continue
+            ranges.append((max(0, file_size - length), file_size - 1))
+            continue
+        start = int(start)
+        if end and int(end) < start:
+            return None
+        if start >= file_size:
+            continue
+        end = int(end) if end else file_size - 1
+        ranges.append((start, min(end, file_size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable
+    # Coalesce overlapping and adjacent ranges (RFC 9110 14.2), so repeating
+    # `0-` cannot make one request stream the file MAX_RANGES times.
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def make_etag(unique_id: str) -> str:
+    return f'"{unique_id}"'
+
+
+def if_range_matches(if_range: Optional[str], etag: str) -> bool:
+    """
+    True when a Range request may be honoured. Only strong ETag validators
+    can match; we expose no Last-Modified, so date validators never do.
+    """
+    if not if_range:
+        return True
+    return if_range.strip() == etag
+
+
+def multipart_boundary() -> str:
+    return secrets.token_hex(16)
+
+
+def multipart_headers(boundary: str, content_type: str, start: int, end: int, file_size: int) -> bytes:
+    return (
+        f"\r\n--{boundary}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+    ).encode()
+
+
+def multipart_footer(boundary: str) -> bytes:
+    return f"\r\n--{boundary}--\r\n".encode()
+
+
+def multipart_length(ranges: List[Tuple[int, int]], boundary: str, content_type: str, file_size: int) -> int:
+    return sum(
+        len(multipart_headers(boundary, content_type, start, end, file_size)) + end - start + 1
+        for start, end in ranges
+    ) + len(multipart_footer(boundary))
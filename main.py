@@ -1,9 +1,11 @@
-from time import time
+import asyncio
+from time import monotonic, time
 from typing import Any, Dict, List, Optional, Union
 from Backend.helper.encrypt import decode_string
 from fastapi import FastAPI, Query, Request, HTTPException
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi.responses import Response, StreamingResponse, HTMLResponse
 import urllib.parse
+from contextlib import aclosing
 
 from fastapi.templating import Jinja2Templates
 
@@ -11,20 +13,30 @@ from fastapi.templating import Jinja2Templates
 
 import mimetypes
 import secrets
-import math
 
 from Backend.logger import LOGGER
 from Backend.config import Telegram
 from Backend.pyrofork import StreamBot, work_loads, multi_clients
-from Backend.helper.exceptions import InvalidHash
-from Backend.helper.custom_dl import ByteStreamer
+from Backend.helper.exceptions import InvalidHash, RangeNotSatisfiable
+from Backend.helper.http_range import (
+    if_range_matches, make_etag, multipart_boundary, multipart_footer,
+    multipart_headers, multipart_length, parse_range
+)
+from Backend.helper.admission import admission
+from Backend.helper.buffers import buffer_budget
+from Backend.helper.chunk_cache import chunk_cache
+from Backend.helper.custom_dl import get_streamer, yield_striped_file
+from Backend.helper.file_cache import file_cache
+from Backend.helper.hls import is_segmentable, render_playlist, segment_index
+from Backend.helper import metrics
 from fastapi.middleware.cors import CORSMiddleware
+from Backend.helper.prefetch import prefetcher
 from Backend.helper.pyro import get_readable_time
+from Backend.helper.scheduler import scheduler
 from Backend import StartTime, __version__, db
 
 
 app = FastAPI()
-class_cache = {}
 
 templates = Jinja2Templates(directory="Backend/fastapi/templates")
 
@@ -56,12 +68,47 @@ async def get_bot_workloads():
                     sorted(work_loads.items(), key=lambda x: x[1], reverse=True)
                 )
             ),
+            "scheduler": scheduler.report(),
+            "chunk_cache": chunk_cache.stats(),
+            "file_cache": file_cache.stats(),
+            "buffers": buffer_budget.stats(),
+            "admission": admission.stats(),
             "version": __version__,
         }
     return response
 
 
 
+metrics.registry.collected(
+    "active_streams", "gauge", "Streams each bot client is serving", ["client"],
+    lambda: {(str(index),): load for index, load in work_loads.items()}
+)
+metrics.registry.collected(
+    "chunk_cache_requests_total", "counter", "Chunk cache lookups by result", ["result"],
+    lambda: {("hit",): chunk_cache.hits, ("miss",): chunk_cache.misses}
+)
+metrics.registry.collected(
+    "file_cache_requests_total", "counter", "File properties cache lookups by result", ["result"],
+    lambda: {("hit",): file_cache.hits, ("miss",): file_cache.misses}
+)
+metrics.registry.collected(
+    "stream_buffer_bytes", "gauge", "Bytes buffered by read-ahead across all streams", [],
+    lambda: {(): buffer_budget.used}
+)
+metrics.registry.collected(
+    "admission_rejected_total", "counter", "/dl requests rejected by admission control", [],
+    lambda: {(): admission.rejected}
+)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Prometheus scrape endpoint.
+    """
+    return Response(content=metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/is_member")
 async def is_member(user_id: int, channel: int):
     try:
@@ -107,11 +154,12 @@ async def watch(
 async def get_sorted_tv_shows(
     sort_by: List[str] = Query(default=["rating:desc"], description="List of fields to sort by. Format: field:direction"),
     page: int = Query(default=1, ge=1, description="Page number to return"),
-    page_size: int = Query(default=10, ge=1, description="Number of TV shows per page")
+    page_size: int = Query(default=10, ge=1, description="Number of TV shows per page"),
+    cursor: Optional[str] = Query(default=None, description="next_cursor of the previous page; takes precedence over page")
 ):
     try:
         sort_params = [tuple(param.split(":")) for param in sort_by]
-        sorted_tv_shows = await db.sort_tv_shows(sort_params, page, page_size)
+        sorted_tv_shows = await db.sort_tv_shows(sort_params, page, page_size, cursor)
         return sorted_tv_shows
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -120,11 +168,12 @@ async def get_sorted_tv_shows(
 async def get_sorted_movies(
     sort_by: List[str] = Query(default=["rating:desc"], description="List of fields to sort by. Format: field:direction"),
     page: int = Query(default=1, ge=1, description="Page number to return"),
-    page_size: int = Query(default=10, ge=1, description="Number of movies per page")
+    page_size: int = Query(default=10, ge=1, description="Number of movies per page"),
+    cursor: Optional[str] = Query(default=None, description="next_cursor of the previous page; takes precedence over page")
 ):
     try:
         sort_params = [tuple(param.split(":")) for param in sort_by]
-        sorted_movies = await db.sort_movies(sort_params, page, page_size)
+        sorted_movies = await db.sort_movies(sort_params, page, page_size, cursor)
         return sorted_movies
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -218,7 +267,7 @@ async def search_documents_endpoint(
 # search tab = http://127.0.0.1:8000/api/search/?query=the%20boys&page=1&page_size=40
 
 
-@app.get('/dl/{id}/{name}')
+@app.api_route('/dl/{id}/{name}', methods=["GET", "HEAD"])
     
 async def stream_handler(request: Request, id: str, name: str):
     decoded_data = await decode_string(id)
@@ -228,23 +277,129 @@ async def stream_handler(request: Request, id: str, name: str):
     return await media_streamer(request, int(chat_id), int(decoded_data['msg_id']), decoded_data['hash'])
 
 
+@app.get('/hls/{id}/index.m3u8')
+async def hls_playlist(id: str):
+    """
+    VOD playlist of byte ranges of the MPEG-TS file behind /dl/{id}, cut into
+    whole TS packets of about HLS_SEGMENT_MB, so players fetch predictable,
+    cacheable segments instead of arbitrary ranges. Other containers cannot
+    be played by HLS clients without remuxing and get 415.
+    """
+    decoded_data = await decode_string(id)
+    if not decoded_data['msg_id'] or not decoded_data['hash']:
+        raise HTTPException(status_code=400, detail="Missing id or hash")
+    chat_id = int(f"-100{decoded_data['chat_id']}")
+    msg_id = int(decoded_data['msg_id'])
+    tg_connect = get_streamer(scheduler.pick(file_cache.dc_of(chat_id, msg_id)))
+    file_id = await tg_connect.get_file_properties(chat_id=chat_id, message_id=msg_id)
+    if file_id.unique_id[:6] != decoded_data['hash']:
+        raise InvalidHash
+    if not is_segmentable(file_id):
+        raise HTTPException(status_code=415, detail="HLS is only available for MPEG-TS files")
+    name = urllib.parse.quote(file_id.file_name or f"{file_id.unique_id}.ts")
+    return Response(
+        content=render_playlist(segment_index.get(file_id), f"/dl/{id}/{name}"),
+        media_type="application/vnd.apple.mpegurl",
+        headers={"Cache-Control": "public, max-age=3600"},
+    )
+
+
 
     
 
 
+def stream_range(tg_connect, file_id, chat_id: int, id: int, from_bytes: int, until_bytes: int):
+    if Telegram.STRIPE_CLIENTS > 1 and until_bytes - from_bytes >= 1024 * 1024 and len(multi_clients) > 1:
+        indexes = scheduler.rank(file_id.dc_id)[:Telegram.STRIPE_CLIENTS]
+        return yield_striped_file(chat_id, id, indexes, from_bytes, until_bytes, tg_connect, file_id)
+    return tg_connect.yield_file(file_id, from_bytes, until_bytes, chat_id, id)
+
+
+async def stream_multipart(tg_connect, file_id, chat_id: int, id: int, ranges, boundary: str, mime_type: str):
+    file_size = file_id.file_size
+    for start, end in ranges:
+        yield multipart_headers(boundary, mime_type, start, end, file_size)
+        async with aclosing(stream_range(tg_connect, file_id, chat_id, id, start, end)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+    yield multipart_footer(boundary)
+
+
+async def empty_body():
+    return
+    yield
+
+
+def client_ip(request: Request) -> str:
+    # Behind the platform proxy the peer address is the proxy itself. Each of
+    # the TRUSTED_PROXIES hops appends the address it saw, so the client is
+    # that many entries from the right; anything further left is whatever the
+    # client chose to send.
+    hops = Telegram.TRUSTED_PROXIES
+    forwarded = [entry.strip() for entry in request.headers.get("X-Forwarded-For", "").split(",") if entry.strip()]
+    if hops and len(forwarded) >= hops:
+        return forwarded[-hops]
+    return request.client.host
+
+
+async def wait_for_disconnect(request: Request) -> None:
+    while not await request.is_disconnected():
+        await asyncio.sleep(Telegram.DISCONNECT_POLL)
+
+
+async def stream_until_disconnect(request: Request, body):
+    """
+    Re-yield body while watching the connection. When the player goes away
+    mid-fetch (typically on seek), the pending part is cancelled at once,
+    which stops upstream GetFile requests and releases work_loads.
+    """
+    watcher = asyncio.create_task(wait_for_disconnect(request))
+    fetch = None
+    try:
+        while True:
+            fetch = asyncio.ensure_future(body.__anext__())
+            done, _ = await asyncio.wait({fetch, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if fetch not in done:
+                fetch.cancel()
+                await asyncio.gather(fetch, return_exceptions=True)
+                LOGGER.debug(f"{request.client.host} disconnected, upstream fetch cancelled")
+                return
+            try:
+                chunk = fetch.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        watcher.cancel()
+        if fetch is not None and not fetch.done():
+            # The server cancelled us while a part was pending. Cancelling the
+            # fetch unwinds body inside its own task; closing it here as well
+            # would fail with "asynchronous generator is already running".
+            fetch.cancel()
+        else:
+            await body.aclose()
+
+
+async def metered(body, started: float, client: str):
+    """
+    re-yield body, recording time to first byte and bytes sent
+    """
+    async with aclosing(body):
+        first = True
+        async for chunk in body:
+            if first:
+                metrics.stream_ttfb.observe(monotonic() - started)
+                first = False
+            metrics.stream_bytes.inc(client, amount=len(chunk))
+            yield chunk
+
+
 async def media_streamer(request: Request, chat_id: int, id: int, secure_hash: str):
-    range_header = request.headers.get("Range", 0)
-    index = min(work_loads, key=work_loads.get)
-    faster_client = multi_clients[index]
+    started = monotonic()
+    index = scheduler.pick(file_cache.dc_of(chat_id, id))
     if Telegram.MULTI_CLIENT:
         LOGGER.debug(f"Client {index} is now serving {request.client.host}")
-    if faster_client in class_cache:
-        tg_connect = class_cache[faster_client]
-        LOGGER.debug(f"Using cached ByteStreamer object for client {index}")
-    else:
-        LOGGER.debug(f"Creating new ByteStreamer object for client {index}")
-        tg_connect = ByteStreamer(faster_client)
-        class_cache[faster_client] = tg_connect
+    tg_connect = get_streamer(index)
     LOGGER.debug("before calling get_file_properties")
     file_id = await tg_connect.get_file_properties(chat_id=chat_id, message_id=id)
     LOGGER.debug("after calling get_file_properties")
@@ -252,31 +407,6 @@ async def media_streamer(request: Request, chat_id: int, id: int, secure_hash: s
         LOGGER.debug(f"Invalid hash for message with ID {id}")
         raise InvalidHash
     file_size = file_id.file_size
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
-    else:
-        from_bytes = 0
-        until_bytes = file_size - 1
-    if (until_bytes > file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
-        return StreamingResponse(
-            content=(f"416: Range not satisfiable",),
-            status_code=416,
-            headers={"Content-Range": f"bytes */{file_size}"},
-        )
-    chunk_size = 1024 * 1024
-    until_bytes = min(until_bytes, file_size - 1)
-
-    offset = from_bytes - (from_bytes % chunk_size)
-    first_part_cut = from_bytes - offset
-    last_part_cut = until_bytes % chunk_size + 1
-
-    req_length = until_bytes - from_bytes + 1
-    part_count = math.ceil(until_bytes / chunk_size) - math.floor(offset / chunk_size)
-    body = tg_connect.yield_file(
-    file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-)
     mime_type = file_id.mime_type
     file_name = file_id.file_name
     disposition = "inline"
@@ -289,26 +419,61 @@ async def media_streamer(request: Request, chat_id: int, id: int, secure_hash: s
                 file_name = f"{secrets.token_hex(2)}.unknown"
     else:
         if file_name:
-            mime_type = mimetypes.guess_type(file_name)[0]
+            mime_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
         else:
             mime_type = "application/octet-stream"
             file_name = f"{secrets.token_hex(2)}.unknown"
 
-    # async def file_chunk_generator():
-    #     async for chunk in tg_connect.yield_file(
-    #         file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-    #     ):
-    #         yield chunk
+    etag = make_etag(file_id.unique_id)
+    headers = {
+        "Content-Type": f"{mime_type}",
+        "Content-Disposition": f'{disposition}; filename="{file_name}"',
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+    }
+
+    range_header = request.headers.get("Range")
+    if not if_range_matches(request.headers.get("If-Range"), etag):
+        range_header = None
+    try:
+        ranges = parse_range(range_header, file_size)
+    except RangeNotSatisfiable:
+        return Response(
+            content="416: Range not satisfiable",
+            status_code=416,
+            headers={"Content-Range": f"bytes */{file_size}", "Accept-Ranges": "bytes"},
+        )
+
+    if ranges is None:
+        status_code = 200
+        headers["Content-Length"] = str(file_size)
+    elif len(ranges) == 1:
+        status_code = 206
+        from_bytes, until_bytes = ranges[0]
+        headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
+        headers["Content-Length"] = str(until_bytes - from_bytes + 1)
+    else:
+        status_code = 206
+        boundary = multipart_boundary()
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["Content-Length"] = str(multipart_length(ranges, boundary, mime_type, file_size))
+
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers)
+
+    ticket = await admission.admit(client_ip(request), file_id.unique_id)
+    if Telegram.PREFETCH and (ranges is None or ranges[0][0] == 0):
+        prefetcher.schedule(chat_id, id, file_id)
+    if ranges is None:
+        body = stream_range(tg_connect, file_id, chat_id, id, 0, file_size - 1) if file_size else empty_body()
+    elif len(ranges) == 1:
+        body = stream_range(tg_connect, file_id, chat_id, id, *ranges[0])
+    else:
+        body = stream_multipart(tg_connect, file_id, chat_id, id, ranges, boundary, mime_type)
+
     LOGGER.info(f"{mime_type}, {file_name}, {disposition}")
     return StreamingResponse(
-        
-        status_code=206 if range_header else 200,
-        content=body,
-        headers={
-            "Content-Type": f"{mime_type}",
-            "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-            "Content-Length": str(req_length),
-            "Content-Disposition": f'{disposition}; filename="{file_name}"',
-            "Accept-Ranges": "bytes",
-        },
+        status_code=status_code,
+        content=admission.guard(ticket, stream_until_disconnect(request, metered(body, started, str(index)))),
+        headers=headers,
     )
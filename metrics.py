@@ -0,0 +1,157 @@
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Upper bounds in seconds, shared by every latency histogram.
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, *label_values, amount: float = 1.0) -> None:
+        self.values[label_values] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, values)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram; observe() is one bisect and three additions.
+    """
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # per label set: [count per bucket..., count above the last bucket], sum
+        self.counts: Dict[Tuple[str, ...], List[int]] = {}
+        self.sums: Dict[Tuple[str, ...], float] = defaultdict(float)
+
+    def observe(self, value: float, *label_values) -> None:
+        counts = self.counts.get(label_values)
+        if counts is None:
+            counts = self.counts[label_values] = [0] * (len(self.buckets) + 1)
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[label_values] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                le = f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, values, le)} {total}")
+            total += counts[-1]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labels, values, le)} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, values)} {_number(self.sums[values])}")
+            lines.append(f"{self.name}_count{_labels(self.labels, values)} {total}")
+        return lines
+
+
+class Collected:
+    """
+    Metric read at scrape time from state the app already keeps, so it costs
+    nothing on the hot path.
+    """
+
+    def __init__(self, name: str, kind: str, help: str, labels: Sequence[str], collect: Callable[[], Dict[Tuple[str, ...], float]]):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_labels(self.labels, values)} {_number(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def collected(self, name: str, kind: str, help: str, labels: Sequence[str], collect) -> Collected:
+        metric = Collected(name, kind, help, labels, collect)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stream_ttfb = registry.histogram(
+    "stream_ttfb_seconds", "Time from receiving a /dl request to sending its first body byte"
+)
+stream_bytes = registry.counter(
+    "stream_bytes_total", "Body bytes sent to players by the client that opened the stream", ["client"]
+)
+getfile_latency = registry.histogram(
+    "getfile_latency_seconds", "Latency of upload.GetFile requests", ["client", "dc"]
+)
+getfile_bytes = registry.counter(
+    "getfile_bytes_total", "Bytes downloaded from Telegram", ["client", "dc"]
+)
+getfile_errors = registry.counter(
+    "getfile_errors_total", "Failed upload.GetFile requests by error", ["client", "error"]
+)
+floodwaits = registry.counter(
+    "floodwait_total", "FloodWait errors received", ["client"]
+)
+floodwait_seconds = registry.counter(
+    "floodwait_seconds_total", "Seconds of FloodWait imposed", ["client"]
+)
+cdn_parts = registry.counter(
+    "cdn_parts_total", "Parts downloaded from Telegram CDN DCs", ["client"]
+)
+cdn_fallbacks = registry.counter(
+    "cdn_fallbacks_total", "CDN downloads that fell back to the file's own DC", ["client"]
+)
+ingest_files = registry.counter(
+    "ingest_files_total", "Files taken from the ingest queue by outcome", ["result"]
+)
+ingest_batch_seconds = registry.histogram(
+    "ingest_batch_seconds", "Time to write one ingest batch to the database"
+)
@@ -0,0 +1,116 @@
+import asyncio
+from time import monotonic
+from typing import Dict, Optional, Tuple
+from pyrogram.file_id import FileId
+from Backend import db
+from Backend.logger import LOGGER
+from Backend.config import Telegram
+from Backend.helper.chunk_cache import chunk_cache
+from Backend.helper.custom_dl import MAX_CHUNK_SIZE, ByteStreamer, get_streamer
+from Backend.helper.encrypt import decode_string
+from Backend.helper.file_cache import file_cache
+from Backend.helper.scheduler import scheduler
+
+
+class Prefetcher:
+    """
+    When playback of an episode starts, warm what the player asks for next:
+    the last MB of the current file (MKV cues / MP4 moov usually sit there)
+    and the file properties, media session and first `size` bytes of the
+    next episode at the same quality. Jobs run one at a time in the
+    background and are dropped when the queue is full, so prefetching never
+    competes with live streams for more than one upstream request.
+    """
+
+    def __init__(self, size: int, max_pending: int = 16, ttl: float = 600):
+        self.size = size
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.recent: Dict[str, float] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+
+    def schedule(self, chat_id: int, message_id: int, file_id: FileId) -> None:
+        now = monotonic()
+        if self.recent.get(file_id.unique_id, 0) > now:
+            return
+        self.recent = {k: v for k, v in self.recent.items() if v > now}
+        self.recent[file_id.unique_id] = now + self.ttl
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.max_pending)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+        try:
+            self.queue.put_nowait((chat_id, message_id, file_id))
+        except asyncio.QueueFull:
+            LOGGER.debug(f"Prefetch queue full, skipping {file_id.unique_id}")
+
+    def stop(self) -> None:
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+
+    async def run(self) -> None:
+        while True:
+            chat_id, message_id, file_id = await self.queue.get()
+            try:
+                await self.prefetch(chat_id, message_id, file_id)
+            except Exception as e:
+                LOGGER.debug(f"Prefetch after {chat_id}/{message_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def prefetch(self, chat_id: int, message_id: int, file_id: FileId) -> None:
+        if file_id.file_size:
+            last = file_id.file_size - 1
+            # FileIds are only valid on the client that resolved them when
+            # SHARE_FILE_IDS is off, so the chosen client resolves its own.
+            streamer = get_streamer(scheduler.pick(file_id.dc_id))
+            tail_file_id = await streamer.get_file_properties(chat_id, message_id)
+            await self.warm(streamer, tail_file_id, last - last % MAX_CHUNK_SIZE, last)
+
+        upcoming = await self.next_episode(chat_id, message_id)
+        if upcoming is None:
+            return
+        next_chat_id, next_message_id = upcoming
+        streamer = get_streamer(scheduler.pick(file_cache.dc_of(next_chat_id, next_message_id)))
+        next_file_id = await streamer.get_file_properties(next_chat_id, next_message_id)
+        await streamer.get_media_session(next_file_id.dc_id)
+        if next_file_id.file_size:
+            await self.warm(streamer, next_file_id, 0, min(self.size, next_file_id.file_size) - 1)
+        LOGGER.debug(f"Prefetched {next_file_id.unique_id} after {file_id.unique_id}")
+
+    @staticmethod
+    async def next_episode(chat_id: int, message_id: int) -> Optional[Tuple[int, int]]:
+        """
+        return (chat_id, message_id) of the next episode at the same quality,
+        looking at the first episode of the next season after the last one
+        """
+        record = await db.get_file_record(chat_id, message_id)
+        if not record or record.get("season_number") is None or record.get("episode_number") is None:
+            return None
+        tmdb_id, quality = record["tmdb_id"], record["quality"]
+        season, episode = record["season_number"], record["episode_number"]
+        found = (
+            await db.get_quality_details(tmdb_id, quality, season, episode + 1)
+            or await db.get_quality_details(tmdb_id, quality, season + 1, 1)
+        )
+        if not found:
+            return None
+        decoded_data = await decode_string(found[0]["id"])
+        return int(f"-100{decoded_data['chat_id']}"), int(decoded_data['msg_id'])
+
+    @staticmethod
+    async def warm(streamer: ByteStreamer, file_id: FileId, from_bytes: int, until_bytes: int) -> None:
+        """
+        pull the 1 MB parts covering from_bytes..until_bytes into the chunk cache
+        """
+        if not chunk_cache.enabled:
+            return
+        media_session = await streamer.generate_media_session(streamer.client, file_id)
+        location = await streamer.get_location(file_id)
+        for offset in range(from_bytes - from_bytes % MAX_CHUNK_SIZE, until_bytes + 1, MAX_CHUNK_SIZE):
+            await streamer.get_chunk(media_session, location, file_id, offset, MAX_CHUNK_SIZE)
+
+
+prefetcher = Prefetcher(Telegram.PREFETCH_MB * 1024 * 1024)
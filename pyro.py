@@ -1,5 +1,5 @@
 import pycountry
-from pyrogram.file_id import FileId
+from pyrogram.file_id import FileId, FileType
 from typing import Optional
 from Backend.logger import LOGGER
 from Backend import __version__, now, timezone
@@ -23,14 +23,50 @@ async def get_file_ids(client: Client, chat_id: int, message_id: int) -> Optiona
     message = await client.get_messages(chat_id, message_id)
     if message.empty:
         raise FIleNotFound
+    return get_media_file_id(is_media(message))
+
+def get_media_file_id(media) -> Optional[FileId]:
     file_id = file_unique_id = None
-    if media := is_media(message):
+    if media:
         file_id, file_unique_id = FileId.decode(
             media.file_id), media.file_unique_id
     setattr(file_id, 'file_name', getattr(media, 'file_name', ''))
     setattr(file_id, 'file_size', getattr(media, 'file_size', 0))
     setattr(file_id, 'mime_type', getattr(media, 'mime_type', ''))
     setattr(file_id, 'unique_id', file_unique_id)
+    setattr(file_id, 'duration', getattr(media, 'duration', 0) or 0)
+    return file_id
+
+def file_id_to_record(file_id: FileId) -> dict:
+    """Flatten a decoded FileId into the fields stored in the files collection."""
+    return {
+        "file_type": int(file_id.file_type),
+        "dc_id": file_id.dc_id,
+        "media_id": file_id.media_id,
+        "access_hash": file_id.access_hash,
+        "file_reference": file_id.file_reference,
+        "thumbnail_size": file_id.thumbnail_size,
+        "unique_id": file_id.unique_id,
+        "size": file_id.file_size,
+        "mime": file_id.mime_type,
+        "name": file_id.file_name,
+        "duration": getattr(file_id, "duration", 0),
+    }
+
+def file_id_from_record(record: dict) -> FileId:
+    file_id = FileId(
+        file_type=FileType(record["file_type"]),
+        dc_id=record["dc_id"],
+        media_id=record["media_id"],
+        access_hash=record["access_hash"],
+        file_reference=bytes(record["file_reference"]),
+        thumbnail_size=record.get("thumbnail_size", ""),
+    )
+    setattr(file_id, 'file_name', record.get('name', ''))
+    setattr(file_id, 'file_size', record.get('size', 0))
+    setattr(file_id, 'mime_type', record.get('mime', ''))
+    setattr(file_id, 'unique_id', record['unique_id'])
+    setattr(file_id, 'duration', record.get('duration', 0))
     return file_id
 
 def get_readable_file_size(size_in_bytes):
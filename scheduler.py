@@ -0,0 +1,133 @@
+from time import monotonic
+from typing import Dict, Iterable, List, Optional
+from Backend.logger import LOGGER
+from Backend.config import Telegram
+from Backend.pyrofork import multi_clients, work_loads
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ClientStats:
+    def __init__(self):
+        # Optimistic priors so clients without samples still get tried.
+        self.latency = 0.5
+        self.bandwidth = CHUNK_SIZE / 0.5
+        self.samples = 0
+        self.penalty_until = 0.0
+        self.failures = 0
+        self.cooldown = 0.0
+
+
+class LeastLoadedScheduler:
+    """
+    Pick the client with the fewest active streams.
+    Subclasses override `score` to rank clients by something smarter.
+    """
+
+    def __init__(self):
+        self.stats: Dict[int, ClientStats] = {}
+
+    def client_stats(self, index: int) -> ClientStats:
+        if index not in self.stats:
+            self.stats[index] = ClientStats()
+        return self.stats[index]
+
+    def score(self, index: int, dc_id: Optional[int]) -> float:
+        return work_loads.get(index, 0)
+
+    def rank(self, dc_id: Optional[int] = None, exclude: Iterable[int] = ()) -> List[int]:
+        """
+        return client indexes ordered from best to worst, skipping clients in
+        a penalty window unless nothing else is left
+        """
+        exclude = set(exclude)
+        now = monotonic()
+        candidates = [i for i in multi_clients if i not in exclude]
+        healthy = [i for i in candidates if self.client_stats(i).penalty_until <= now]
+        return sorted(healthy or candidates, key=lambda i: self.score(i, dc_id))
+
+    def pick(self, dc_id: Optional[int] = None, exclude: Iterable[int] = ()) -> int:
+        ranked = self.rank(dc_id, exclude)
+        return ranked[0] if ranked else min(work_loads, key=work_loads.get)
+
+    def record(self, index: int, elapsed: float, size: int) -> None:
+        stats = self.client_stats(index)
+        stats.samples += 1
+        stats.failures = 0
+        stats.cooldown = 0.0
+
+    def record_failure(self, index: int) -> None:
+        """
+        Circuit breaker: after BREAKER_THRESHOLD consecutive failures the
+        client is taken out of rotation, for twice as long each time it trips
+        again without a successful request in between.
+        """
+        stats = self.client_stats(index)
+        stats.failures += 1
+        if stats.failures >= Telegram.BREAKER_THRESHOLD:
+            stats.failures = 0
+            stats.cooldown = min(max(stats.cooldown * 2, Telegram.BREAKER_COOLDOWN), 600.0)
+            self.penalize(index, stats.cooldown)
+
+    def penalize(self, index: int, seconds: float) -> None:
+        stats = self.client_stats(index)
+        stats.penalty_until = max(stats.penalty_until, monotonic() + seconds)
+        LOGGER.info(f"Client {index} penalized for {seconds}s")
+
+    def report(self) -> Dict[str, dict]:
+        now = monotonic()
+        return {
+            f"bot{index + 1}": {
+                "latency_ms": round(stats.latency * 1000, 1),
+                "bandwidth_kbps": round(stats.bandwidth / 1024, 1),
+                "samples": stats.samples,
+                "failures": stats.failures,
+                "penalty_s": round(max(0.0, stats.penalty_until - now), 1),
+            }
+            for index, stats in sorted(self.stats.items())
+        }
+
+
+class EwmaScheduler(LeastLoadedScheduler):
+    """
+    Estimate how long each client would take to deliver the next part from
+    EWMA GetFile latency and bandwidth, its current load, and whether it
+    already holds a media session for the file's DC.
+    """
+
+    def __init__(self, alpha: float = Telegram.SCHEDULER_ALPHA, cold_session_cost: float = 1.5):
+        super().__init__()
+        self.alpha = alpha
+        self.cold_session_cost = cold_session_cost
+
+    def score(self, index: int, dc_id: Optional[int]) -> float:
+        stats = self.client_stats(index)
+        transfer = CHUNK_SIZE / max(stats.bandwidth, 1.0)
+        estimate = stats.latency + transfer * (work_loads.get(index, 0) + 1)
+        client = multi_clients.get(index)
+        if dc_id is not None and client is not None and dc_id not in client.media_sessions:
+            estimate += self.cold_session_cost
+        return estimate
+
+    def record(self, index: int, elapsed: float, size: int) -> None:
+        """
+        Split a GetFile duration into time-to-response and transfer time.
+        Every sample updates latency, less the transfer time the current
+        bandwidth estimate accounts for; only full 1 MB parts update the
+        bandwidth, since small ramp-up parts are almost all latency.
+        """
+        super().record(index, elapsed, size)
+        stats = self.client_stats(index)
+        latency = max(elapsed - size / max(stats.bandwidth, 1.0), 0.0)
+        stats.latency += self.alpha * (latency - stats.latency)
+        transfer = elapsed - stats.latency
+        if size >= CHUNK_SIZE and transfer > 0:
+            stats.bandwidth += self.alpha * (size / transfer - stats.bandwidth)
+
+
+SCHEDULERS = {
+    "least_loaded": LeastLoadedScheduler,
+    "ewma": EwmaScheduler,
+}
+
+scheduler = SCHEDULERS.get(Telegram.SCHEDULER, EwmaScheduler)()
@@ -4,9 +4,11 @@ from Backend.logger import LOGGER
 from Backend import db
 from Backend.config import Telegram
 from Backend.helper.custom_filter import CustomFilters
+from Backend.helper.drain import drainer
 from Backend.helper.encrypt import decode_string
 from Backend.helper.metadata import metadata
-from Backend.helper.pyro import clean_filename, get_readable_file_size, remove_urls
+from Backend.helper.metrics import ingest_batch_seconds, ingest_files
+from Backend.helper.pyro import clean_filename, file_id_to_record, get_media_file_id, get_readable_file_size, remove_urls
 from Backend.pyrofork import StreamBot
 from pyrogram import filters, Client
 from pyrogram.types import Message
@@ -14,7 +16,8 @@ from os import path as ospath
 from pyrogram.errors import FloodWait
 from pyrogram.enums.parse_mode import ParseMode
 from themoviedb import aioTMDb
-from asyncio import Queue, create_task
+from asyncio import Queue, TimeoutError as QueueTimeout, create_task, wait_for
+from time import monotonic
 from os import execl as osexecl
 from asyncio import create_subprocess_exec, gather
 from sys import executable
@@ -94,6 +97,9 @@ async def restart(bot: Client, message: Message):
         proc1 = await create_subprocess_exec('python3', 'update.py')
         await gather(proc1.wait())
 
+        # Let active streams and queued files finish before the process is replaced
+        await drainer.drain()
+
         # Save restart message details for notification after restart
         async with aiopen(".restartmsg", "w") as f:
             await f.write(f"{restart_message.chat.id}\n{restart_message.id}\n")
@@ -103,6 +109,8 @@ async def restart(bot: Client, message: Message):
 
     except Exception as e:
         LOGGER.error(f"Error during restart: {e}")
+        # Still running, so stop refusing /dl requests
+        drainer.resume()
         await message.reply_text("**❌ Failed to restart. Check logs for details.**")
 
 
@@ -217,32 +225,61 @@ async def start(bot: Client, message: Message):
 
 # Global queue for processing file updates
 file_queue = Queue()
+drainer.watch(file_queue)
+
+async def next_batch() -> list:
+    """
+    wait for one queued file, then collect more until INGEST_BATCH_SIZE
+    files or INGEST_BATCH_WINDOW seconds
+    """
+    batch = [await file_queue.get()]
+    deadline = monotonic() + Telegram.INGEST_BATCH_WINDOW
+    while len(batch) < Telegram.INGEST_BATCH_SIZE:
+        if not file_queue.empty():
+            batch.append(file_queue.get_nowait())
+            continue
+        try:
+            batch.append(await wait_for(file_queue.get(), max(deadline - monotonic(), 0)))
+        except QueueTimeout:
+            break
+    return batch
 
-from asyncio import Lock
-
-# Global lock for database access
-db_lock = Lock()
-
-async def process_file():
+async def process_files():
+    ingested = 0
     while True:
-        metadata_info, hash, channel, msg_id, size, title = await file_queue.get()
-
-        # Acquire the lock before updating the database
-        async with db_lock:
-            updated_id = await db.insert_media(metadata_info, hash=hash, channel=channel, msg_id=msg_id, size=size, name=title)
-
-            if updated_id:
-                LOGGER.info(f"{metadata_info['media_type']} updated with ID: {updated_id}")
-            else:
-                LOGGER.info("Update failed due to validation errors.")
+        batch = await next_batch()
+        started = monotonic()
+        try:
+            results = await db.insert_media_batch([
+                {"metadata_info": metadata_info, "hash": hash, "channel": channel, "msg_id": msg_id, "size": size, "name": title}
+                for metadata_info, hash, channel, msg_id, size, title in batch
+            ])
+        except Exception as e:
+            LOGGER.error(f"Writing a batch of {len(batch)} files failed: {e}")
+            results = [e] * len(batch)
+        elapsed = monotonic() - started
+        ingest_batch_seconds.observe(elapsed)
+
+        failed = 0
+        for (metadata_info, _, channel, msg_id, _, title), result in zip(batch, results):
+            if isinstance(result, Exception) or result is None:
+                failed += 1
+                LOGGER.error(f"Failed to add {title} ({channel}/{msg_id}): {result or 'validation error'}")
+        ingested += len(batch) - failed
+        ingest_files.inc("ok", amount=len(batch) - failed)
+        ingest_files.inc("failed", amount=failed)
+        LOGGER.info(
+            f"Ingested {len(batch) - failed}/{len(batch)} files in {elapsed:.2f}s "
+            f"({len(batch) / max(elapsed, 1e-3):.0f} files/s), {ingested} in total, {file_queue.qsize()} queued"
+        )
 
-        file_queue.task_done()
+        for _ in batch:
+            file_queue.task_done()
 
 
 
-# Start the file processing tasks (adjust the number of workers as needed)
-for _ in range(1):  # Two concurrent workers
-    create_task(process_file())
+# One consumer: a batch is diffed against the stored documents before it is written
+create_task(process_files())
 
 @StreamBot.on_message(
     filters.channel
@@ -262,6 +299,11 @@ async def file_receive_handler(bot: Client, message: Message):
                     title = file.file_name or file.file_id
                 msg_id = message.id
                 hash = file.file_unique_id[:6]
+                try:
+                    await db.save_file_ids(message.chat.id, msg_id, file_id_to_record(get_media_file_id(file)))
+                except Exception as e:
+                    # Only a cache for /dl; the file is still catalogued
+                    LOGGER.error(f"Failed to store FileId of message {msg_id}: {e}")
                 size = get_readable_file_size(file.file_size)
                 channel = str(message.chat.id).replace("-100","")
                 
@@ -270,6 +312,11 @@ async def file_receive_handler(bot: Client, message: Message):
                 if metadata_info is None:
                     return
 
+                try:
+                    await db.save_file_media(message.chat.id, msg_id, metadata_info)
+                except Exception as e:
+                    # Only used to find the next episode to prefetch
+                    LOGGER.error(f"Failed to store media details of message {msg_id}: {e}")
 
                 # Add file data to the queue for processing
                 title = remove_urls(title)